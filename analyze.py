@@ -0,0 +1,260 @@
+"""Crunches numbers from the telemetry logs the game writes.
+
+Usage: python analyze.py [-j JOBS] telemetry.db [more.db ...]
+
+Each log gets streamed through a chain of generators and folded into a
+Summary, which only keeps running aggregates (counts, means and
+t-digest quantile sketches) per question and per reveal stage, so
+memory stays flat however big the logs get. Several logs are
+summarized in parallel and the partial Summaries merged at the end.
+
+Reports, per question (hardest first), how often it's answered right
+and how long answers take; answer times by the reveal stage showing
+when the answer went in; and how the answer value (the score curve
+from QuestionOverlay._updateValue) is distributed.
+"""
+import sys
+import sqlite3
+import optparse
+import multiprocessing
+
+#-----------------------------------------------------------------------------
+
+class Stats:
+	"""Count, mean and variance, updated one value at a time."""
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	def add(self, x):
+		self.count += 1
+		delta = x - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (x - self.mean)
+
+	def merge(self, other):
+		if other.count == 0:
+			return
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean += delta * other.count / count
+		self.m2 += other.m2 + delta * delta * self.count * other.count / count
+		self.count = count
+
+	def stddev(self):
+		if self.count < 2:
+			return 0.0
+		return (self.m2 / (self.count - 1)) ** 0.5
+
+class Digest:
+	"""A merging t-digest: a bounded set of (mean, weight) centroids that
+	are kept smaller near the tails, so quantiles come out accurate in
+	constant memory. Digests can be merged.
+	"""
+	def __init__(self, compression=100):
+		self.compression = compression
+		self.centroids = []
+		self.buffer = []
+		self.total = 0
+		self.min = None
+		self.max = None
+
+	def add(self, x, weight=1):
+		self.buffer.append((x, weight))
+		self.total += weight
+		if self.min == None or x < self.min:
+			self.min = x
+		if self.max == None or x > self.max:
+			self.max = x
+		if len(self.buffer) > self.compression * 5:
+			self._compress()
+
+	def merge(self, other):
+		if other.total == 0:
+			return
+		self.buffer.extend(other.centroids)
+		self.buffer.extend(other.buffer)
+		self.total += other.total
+		if self.min == None or other.min < self.min:
+			self.min = other.min
+		if self.max == None or other.max > self.max:
+			self.max = other.max
+		self._compress()
+
+	def _compress(self):
+		if not self.buffer:
+			return
+		items = sorted(self.centroids + self.buffer)
+		self.buffer = []
+		total = float(self.total)
+		merged = []
+		soFar = 0.0
+		mean, weight = items[0]
+		for x, w in items[1:]:
+			# Centroids can hold more the closer they are to the median
+			q = (soFar + weight + w/2.0) / total
+			limit = 4.0 * total * q * (1.0 - q) / self.compression
+			if weight + w <= limit:
+				weight += w
+				mean += (x - mean) * w / weight
+			else:
+				merged.append((mean, weight))
+				soFar += weight
+				mean, weight = x, w
+		merged.append((mean, weight))
+		self.centroids = merged
+
+	def quantile(self, q):
+		self._compress()
+		if not self.centroids:
+			return None
+		target = q * self.total
+		soFar = 0.0
+		prevCenter, prevMean = 0.0, self.min
+		for mean, weight in self.centroids:
+			center = soFar + weight/2.0
+			if target <= center:
+				if center == prevCenter:
+					return mean
+				r = (target - prevCenter) / (center - prevCenter)
+				return prevMean + (mean - prevMean) * r
+			prevCenter, prevMean = center, mean
+			soFar += weight
+		# Past the last centroid's center; head for the max
+		if self.total == prevCenter:
+			return self.max
+		r = (target - prevCenter) / (self.total - prevCenter)
+		return prevMean + (self.max - prevMean) * r
+
+#-----------------------------------------------------------------------------
+
+class AnswerStats:
+	"""How one question (or stage) went over all its answers."""
+	def __init__(self):
+		self.right = 0
+		self.times = Stats()
+		self.timeDigest = Digest()
+
+	def add(self, answer):
+		self.right += answer["correct"]
+		self.times.add(answer["answerTime"])
+		self.timeDigest.add(answer["answerTime"])
+
+	def merge(self, other):
+		self.right += other.right
+		self.times.merge(other.times)
+		self.timeDigest.merge(other.timeDigest)
+
+VALUE_BUCKET = 100
+
+class Summary:
+	def __init__(self):
+		self.sessions = 0
+		self.questions = {}
+		self.stages = {}
+		self.values = {} # bucket -> count
+
+	def add(self, answer):
+		self.questions.setdefault(answer["question"], AnswerStats()).add(answer)
+		self.stages.setdefault(answer["stage"], AnswerStats()).add(answer)
+		bucket = int(answer["value"]) // VALUE_BUCKET * VALUE_BUCKET
+		self.values[bucket] = self.values.get(bucket, 0) + 1
+
+	def merge(self, other):
+		self.sessions += other.sessions
+		for table, otherTable in [(self.questions, other.questions), (self.stages, other.stages)]:
+			for key, stats in otherTable.items():
+				table.setdefault(key, AnswerStats()).merge(stats)
+		for bucket, n in other.values.items():
+			self.values[bucket] = self.values.get(bucket, 0) + n
+
+#-----------------------------------------------------------------------------
+
+def readEvents(path):
+	"""Streams events out of a telemetry log as dicts."""
+	db = sqlite3.connect(path)
+	cursor = db.execute("SELECT session, kind, question, stage, selection, correct, "
+						"answerTime, value, scoreDelta, score FROM events ORDER BY id")
+	names = [x[0] for x in cursor.description]
+	for row in cursor:
+		yield dict(zip(names, row))
+	db.close()
+
+def countSessions(events, summary):
+	"""Passes events through, counting sessions on the way."""
+	for event in events:
+		if event["kind"] == "session-end":
+			summary.sessions += 1
+		yield event
+
+def answers(events):
+	for event in events:
+		if event["kind"] == "answer" and event["answerTime"] != None:
+			yield event
+
+def summarize(path):
+	summary = Summary()
+	for answer in answers(countSessions(readEvents(path), summary)):
+		summary.add(answer)
+	return summary
+
+def summarizeAll(paths, jobs):
+	if jobs > 1 and len(paths) > 1:
+		pool = multiprocessing.Pool(min(jobs, len(paths)))
+		partials = pool.map(summarize, paths)
+		pool.close()
+	else:
+		partials = map(summarize, paths)
+	total = Summary()
+	for partial in partials:
+		total.merge(partial)
+	return total
+
+#-----------------------------------------------------------------------------
+
+def fmt(x, pattern="%6.2f"):
+	if x == None:
+		return "     -"
+	return pattern % x
+
+def report(summary):
+	print("%d complete sessions" % summary.sessions)
+	print()
+	print("Questions, hardest first:")
+	print("  %-14s %7s %7s %7s %7s %7s" % ("question", "answers", "right", "mean", "median", "90%"))
+	def accuracy(name):
+		stats = summary.questions[name]
+		return float(stats.right) / stats.times.count
+	for name in sorted(summary.questions.keys(), key=accuracy):
+		stats = summary.questions[name]
+		print("  %-14s %7d %6.0f%% %s %s %s" % (name, stats.times.count, accuracy(name)*100,
+				fmt(stats.times.mean, "%7.2f"), fmt(stats.timeDigest.quantile(0.5), "%7.2f"),
+				fmt(stats.timeDigest.quantile(0.9), "%7.2f")))
+	print()
+	print("Answer times by reveal stage:")
+	print("  %-5s %7s %7s %7s %7s" % ("stage", "answers", "right", "median", "90%"))
+	for stage in sorted(summary.stages.keys()):
+		stats = summary.stages[stage]
+		print("  %-5d %7d %6.0f%% %s %s" % (stage, stats.times.count,
+				100.0*stats.right/stats.times.count,
+				fmt(stats.timeDigest.quantile(0.5), "%7.2f"), fmt(stats.timeDigest.quantile(0.9), "%7.2f")))
+	print()
+	print("Answer values:")
+	if summary.values:
+		most = max(summary.values.values())
+		for bucket in sorted(summary.values.keys()):
+			n = summary.values[bucket]
+			print("  %4d-%4d %6d %s" % (bucket, bucket+VALUE_BUCKET-1, n, "#" * (n*50//most)))
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [-j JOBS] telemetry.db [more.db ...]")
+	parser.add_option("-j", "--jobs", type="int", default=multiprocessing.cpu_count(),
+					  help="how many logs to crunch at once")
+	options, paths = parser.parse_args()
+	if not paths:
+		parser.error("need at least one telemetry log")
+	report(summarizeAll(paths, options.jobs))
+
+if __name__ == '__main__':
+	main()
@@ -1 +1,24 @@
-fullscreen = 1
\ No newline at end of file
+fullscreen = 1
+# In fullscreen, keep the display's own resolution and scale the game up
+# to it by the biggest whole number that fits (0 = switch to 640x480)
+scaling = 1
+# Print render, culling and input latency stats when the game exits
+showStats = 0
+# Print live node counts (and anything leaked) on every screen change
+debugNodes = 0
+# SQLite file to log per-question telemetry to (None to turn it off)
+telemetry = "telemetry.db"
+# SQLite file to keep the high score table in (None to turn it off)
+scores = "scores.db"
+# Share decoded images with other copies of the game on this machine
+# (needs Python 3.8+ and pygame 2)
+sharedAssets = 0
+# Port to stream the game to spectator screens on (0 to turn it off;
+# needs NumPy.) Watch with "python spectator.py HOST PORT"
+spectatorPort = 0
+# Mixer buffer size in samples; smaller means less sound effect lag
+# (too small and the audio stutters)
+mixerBuffer = 512
+# Watch images/ and questions.txt, and pick up changes between questions
+# without restarting
+hotReload = 0
@@ -2,15 +2,27 @@ import sys,os
 import pygame
 from pygame.locals import *
 import math
-import operator
+import time
 import config
 import random
 import weakref
+import gc
+import threading
+import queue
+import telemetry
+import scores
+import sqlite3
+import sharedassets
+import spectator
 
 # 257, 409
 
 class QuitGameException(Exception): pass
 
+# The most precise clock we've got, for timing input. (pygame's ticks
+# are only milliseconds, and time.time() is ~15ms on Windows)
+preciseTime = time.perf_counter
+
 #-----------------------------------------------------------------------------	
 
 def linearPath(t, points):
@@ -38,16 +50,62 @@ def linearPath(t, points):
 
 #-----------------------------------------------------------------------------
 
+class Animation:
+	"""A sequence of frames, driven by a table of (frame, duration in
+	seconds) pairs. Loops, unless loop is False, in which case it plays
+	once and then there's no frame at all.
+	"""
+	def __init__(self, table, loop=True):
+		assert len(table) > 0
+		self.table = table
+		self.loop = loop
+		self.length = 0.0
+		for frame, duration in table:
+			assert duration > 0
+			self.length += duration
+			
+	def frameAt(self, t):
+		"""Returns the frame that should be showing t seconds in, or None
+		if a one-shot animation is over."""
+		if not self.loop:
+			if t >= self.length:
+				return None
+			t = max(t, 0)
+		t = math.fmod(t, self.length)
+		for frame, duration in self.table:
+			if t < duration:
+				return frame
+			t -= duration
+		return self.table[-1][0]
+		
+	def timeToNextFrame(self, t):
+		"""How long after t seconds in the frame will change (None if
+		it's a one-shot animation that's over.)"""
+		if t < 0:
+			return self.table[0][1] - t
+		if not self.loop and t >= self.length:
+			return None
+		t = math.fmod(t, self.length)
+		for frame, duration in self.table:
+			if t < duration:
+				return duration - t
+			t -= duration
+		return 0
+
+#-----------------------------------------------------------------------------
+
 class Node:
 	def __init__(self, parent, game=None, paused=False, visible=True, state=0, children=[], zOrder=0):
 		if parent == None:
 			assert game != None, "Cannot use parent=None unless you supply a game"
 			self.parent = None
-			self.game = game
+			self.game = weakref.proxy(game)
 		else:
 			assert isinstance(parent, Node), "Parent must be a node"
 			assert game == None, "Cannot supply a game unless parent=None"
-			self.parent = parent
+			# Back-references are weak, so dropping a node from its
+			# parent's child list is enough to free it
+			self.parent = weakref.proxy(parent)
 			self.game = parent.game
 		self.kill = False
 		self.result = 0
@@ -58,12 +116,23 @@ class Node:
 		self.zOrder = zOrder
 		self.birthTicks = pygame.time.get_ticks()
 		self.time = 0
+		# Bounds cache, filled in by getTreeBounds() once per frame
+		self.boundsFrame = -1
+		self.bounds = None
+		self.treeBounds = None
+		self.treeCount = 0
+		# Last frame render() got called in, so nodes drawn into several
+		# dirty rects only count once
+		self.drawnFrame = -1
+		# When unlink() was called, so leaks can be spotted
+		self.unlinkTicks = None
+		self.game.nodeTracker.add(self)
 		
 	def addChild(self, c):
 		assert isinstance(c, Node), "child to add must be a Node"
 		assert c != self, "Cannot be a child of yourself!"
 		self.children.append(c)
-		self.children.sort(lambda a,b: cmp(a.zOrder,b.zOrder))
+		self.children.sort(key=lambda c: c.zOrder)
 			
 	def generalUpdate(self):
 		self.time = (pygame.time.get_ticks() - self.birthTicks)/1000.0
@@ -79,16 +148,18 @@ class Node:
 				needKill = True
 				
 		if needKill:
-			self.killed = [x for x in self.children if x.kill]
+			# (Don't keep these around, they'd stay alive until the next kill)
+			killed = [x for x in self.children if x.kill]
 			self.children = [x for x in self.children if not x.kill]
 			
 			# TODO: This is kind of bad, it gives you unlinked children to work on
-			for k in self.killed:
+			for k in killed:
 				self.onChildKilled(k)
 				
 	def unlink(self):
 		for c in self.children:
 			c.unlink()
+		self.unlinkTicks = pygame.time.get_ticks()
 		self.parent = None
 		self.game = None
 				
@@ -103,17 +174,180 @@ class Node:
 			
 	def update(self): pass
 	
+	def nextChange(self):
+		"""How many seconds until this node changes how things look on
+		its own (not counting its children): 0 if it animates every frame,
+		None if it's going to sit still until something else changes it.
+		Nodes are assumed to be animating unless they say otherwise.
+		"""
+		return 0
+		
+	def generalNextChange(self):
+		"""Soonest nextChange() in this subtree, or None if it's all still."""
+		soonest = None
+		if not self.paused:
+			soonest = self.nextChange()
+		for child in self.children:
+			if soonest == 0:
+				break
+			t = child.generalNextChange()
+			if t != None and (soonest == None or t < soonest):
+				soonest = t
+		return soonest
+	
 	def generalRender(self):
 		if self.visible:
-			self.render()
+			game = self.game
+			treeBounds = self.getTreeBounds()
+			if treeBounds == None or not treeBounds.colliderect(game.renderRect):
+				# Nothing in this whole subtree can show up, skip it
+				return
+			
+			if self.bounds != None and self.bounds.colliderect(game.renderRect):
+				self.render()
+				if self.drawnFrame != game.frame:
+					self.drawnFrame = game.frame
+					game.nodesDrawn += 1
 			
 			for child in self.children:
 				child.generalRender()
 				
 	def render(self): pass
+	
+	def getDrawKey(self):
+		"""Returns something that changes whenever what render() draws
+		changes (like (surface, position)), or None if it draws nothing.
+		Used to notice when a frame would look exactly like the last one,
+		and which parts of it changed if not.
+		"""
+		return None
+		
+	def collectDrawKeys(self, keys):
+		"""Adds (draw key, bounds) for everything visible in the subtree."""
+		if self.visible:
+			key = self.getDrawKey()
+			if key != None:
+				keys.append((key, self.getBounds()))
+			for child in self.children:
+				child.collectDrawKeys(keys)
+	
+	def getBounds(self):
+		"""Returns the screen rectangle that render() draws into, or None
+		if this node doesn't draw anything itself. Anything that overrides
+		render() needs to override this too, or it will get culled.
+		"""
+		return None
+		
+	def getTreeBounds(self):
+		"""Returns the union of this node's bounds and those of all its
+		visible children, or None if nothing in the subtree draws.
+		Also counts the visible nodes in the subtree that draw something
+		(in treeCount.)
+		The result is cached until the game moves on to the next frame.
+		"""
+		if self.boundsFrame == self.game.frame:
+			return self.treeBounds
+		self.boundsFrame = self.game.frame
+		
+		self.bounds = None
+		self.treeBounds = None
+		self.treeCount = 0
+		if not self.visible:
+			return None
+			
+		self.bounds = self.getBounds()
+		treeBounds = self.bounds
+		count = [0,1][self.bounds != None]
+		for child in self.children:
+			childBounds = child.getTreeBounds()
+			count += child.treeCount
+			if childBounds == None:
+				continue
+			if treeBounds == None:
+				treeBounds = childBounds
+			else:
+				treeBounds = treeBounds.union(childBounds)
+		self.treeBounds = treeBounds
+		self.treeCount = count
+		return treeBounds
 
 #-----------------------------------------------------------------------------	
 
+class NodeTracker:
+	"""Keeps weak references to every node that's been created, so we can
+	see what's piling up when the game has been running for days.
+	"""
+	def __init__(self):
+		self.nodes = weakref.WeakKeyDictionary()
+		self.reportPending = False
+		
+	def add(self, node):
+		self.nodes[node] = True
+		
+	def requestReport(self):
+		"""Asks for a report at the end of the current frame, once
+		anything that's been killed has been unlinked."""
+		self.reportPending = True
+		
+	def report(self):
+		self.reportPending = False
+		gc.collect()
+		now = pygame.time.get_ticks()
+		
+		counts = {}
+		surfaceBytes = {}
+		seenSurfaces = {}
+		leaked = []
+		pooled = 0
+		for node in list(self.nodes.keys()):
+			if getattr(node, "inPool", False):
+				pooled += 1
+				continue
+			name = node.__class__.__name__
+			counts[name] = counts.get(name, 0) + 1
+			surfaceBytes[name] = surfaceBytes.get(name, 0) + self._surfaceBytes(node, seenSurfaces)
+			if node.unlinkTicks != None:
+				leaked.append(node)
+				
+		names = sorted(counts.keys())
+		print("*** %d live nodes, holding %d KB of surfaces" % (
+				sum(counts.values()), sum(surfaceBytes.values())//1024))
+		for name in names:
+			print("***   %s: %d (%d KB)" % (name, counts[name], surfaceBytes[name]//1024))
+		if pooled:
+			print("*** (plus %d nodes sitting in pools)" % pooled)
+			
+		if leaked:
+			print("*** %d nodes are still alive after being unlinked!" % len(leaked))
+			here = sys._getframe()
+			for node in leaked:
+				referrers = [x.__class__.__name__ for x in gc.get_referrers(node)
+							 if x is not leaked and x is not here]
+				print("***   %s, unlinked %.1f sec ago, referred to by %s" % (
+						node.__class__.__name__, (now-node.unlinkTicks)/1000.0,
+						", ".join(referrers)))
+						
+	def _surfaceBytes(self, node, seenSurfaces):
+		"""Adds up the pixel memory of surfaces a node holds that haven't
+		been counted yet (subsurfaces count as their whole parent)."""
+		total = 0
+		for value in node.__dict__.values():
+			if isinstance(value, pygame.Surface):
+				surfs = [value]
+			elif isinstance(value, list):
+				surfs = [x for x in value if isinstance(x, pygame.Surface)]
+			else:
+				continue
+			for surf in surfs:
+				surf = surf.get_abs_parent()
+				if id(surf) in seenSurfaces:
+					continue
+				seenSurfaces[id(surf)] = surf
+				total += surf.get_pitch() * surf.get_height()
+		return total
+	
+#-----------------------------------------------------------------------------	
+
 class Sprite(Node):
 	def __init__(self, parent, image, x=0, y=0, centered=False, **kwargs):
 		#assert isinstance(overlay, Overlay), "overlay must be an Overlay"
@@ -122,8 +356,14 @@ class Sprite(Node):
 		self.y = y
 		self.centered = centered
 		self.frame = 0
-		
-		if operator.isSequenceType(image) and not isinstance(image, str):
+		# Set by SpritePool: hand this back to the pool when unlinked
+		self.pooled = False
+		self.inPool = False
+		# If set, the images came from the game's SurfacePool and go
+		# back to it when this is unlinked
+		self.ownsImages = False
+		
+		if isinstance(image, (list, tuple)):
 			assert len(image) > 0
 			self.images = [self._convertImageListItem(x) for x in image]
 		else:
@@ -131,6 +371,22 @@ class Sprite(Node):
 				
 		self.imageSize = self.images[0].get_size()
 		
+	def setImage(self, image):
+		"""Swaps in a single new image (a Surface or a path), going back to frame 0."""
+		self.images = [self._convertImageListItem(image)]
+		self.imageSize = self.images[0].get_size()
+		self.frame = 0
+		
+	def unlink(self):
+		game = self.game
+		Node.unlink(self)
+		if self.ownsImages:
+			for image in self.images:
+				game.surfacePool.release(image)
+		if self.pooled:
+			self.images = []
+			game.spritePool.release(self)
+		
 	def _convertImageListItem(self, image):
 		assert isinstance(image, pygame.Surface) or isinstance(image, str), \
 				"image must be a string or a Surface"
@@ -146,15 +402,75 @@ class Sprite(Node):
 		assert self.frame < len(self.images) and self.frame >= 0
 		self.game.screen.blit(self.images[self.frame], (x,y))
 		
+	def getBounds(self):
+		return pygame.Rect(self.getTopLeft(), self.images[self.frame].get_size())
+		
+	def getDrawKey(self):
+		return (self.images[self.frame], self.getTopLeft())
+		
+	def nextChange(self):
+		# Plain sprites only move when something moves them
+		return None
+		
 	def getTopLeft(self):
 		x,y = self.x, self.y
 		if self.centered:
-			x -= self.imageSize[0]/2
-			y -= self.imageSize[1]/2
+			x -= self.imageSize[0]//2
+			y -= self.imageSize[1]//2
 		return x,y
 
 #-----------------------------------------------------------------------------	
 
+class SpritePool:
+	"""Keeps unlinked Sprites around so they can be reused instead of
+	making new ones (ImageRevealer goes through hundreds per question.)
+	Only plain Sprites get pooled, not subclasses.
+	"""
+	def __init__(self, limit=256):
+		self.limit = limit
+		self.free = []
+		
+	def get(self, parent, image, **kwargs):
+		"""Works like Sprite(parent, image, **kwargs), but recycles a
+		released Sprite if there is one."""
+		if self.free:
+			spr = self.free.pop()
+			# Start over from scratch, so nothing from the last use sticks around
+			spr.__dict__.clear()
+			Sprite.__init__(spr, parent, image, **kwargs)
+		else:
+			spr = Sprite(parent, image, **kwargs)
+		spr.pooled = True
+		return spr
+		
+	def release(self, spr):
+		assert spr.__class__ == Sprite, "Only plain Sprites can be pooled"
+		if len(self.free) < self.limit:
+			spr.inPool = True
+			self.free.append(spr)
+			
+class SurfacePool:
+	"""Display-format surfaces, handed out by size and reused when released.
+	Released surfaces aren't cleared, so whoever gets one should draw
+	over all of it.
+	"""
+	def __init__(self, limitPerSize=128):
+		self.limitPerSize = limitPerSize
+		self.free = {}
+		
+	def get(self, size):
+		free = self.free.get(size)
+		if free:
+			return free.pop()
+		return pygame.Surface(size).convert()
+		
+	def release(self, surf):
+		free = self.free.setdefault(surf.get_size(), [])
+		if len(free) < self.limitPerSize:
+			free.append(surf)
+
+#-----------------------------------------------------------------------------	
+
 class Text(Node):
 	def __init__(self, parent, font, text='', x=0, y=0, **kwargs):
 		#assert isinstance(font, pygame.Font), "font must be a Pygame font"
@@ -172,10 +488,22 @@ class Text(Node):
 			self.surf = None
 		self.text = text
 		
-	def render(self):
+	def _getSurf(self):
 		if not self.surf:
 			self.surf = self.font.render(self.text, True, (255,255,255,255), (0,0,0,255))
-		self.game.screen.blit(self.surf, (self.x,self.y))
+		return self.surf
+		
+	def render(self):
+		self.game.screen.blit(self._getSurf(), (self.x,self.y))
+		
+	def getBounds(self):
+		return pygame.Rect((self.x,self.y), self._getSurf().get_size())
+		
+	def getDrawKey(self):
+		return (self._getSurf(), (self.x,self.y))
+		
+	def nextChange(self):
+		return None
 
 #-----------------------------------------------------------------------------		
 
@@ -185,10 +513,17 @@ class ScrollyThing(Sprite):
 		self.points = points
 		
 	def update(self):
-		self.x = 640/2
+		self.x = 640//2
 		self.y = linearPath(self.time, self.points)
 		self.visible = (self.time >= self.points[0][0] and
 						self.time <= self.points[-1][0])
+						
+	def nextChange(self):
+		if self.time < self.points[0][0]:
+			return self.points[0][0] - self.time
+		elif self.time <= self.points[-1][0]:
+			return 0
+		return None
 					
 class IntroTextOverlay(Node):
 	def __init__(self, parent, **kwargs):
@@ -246,11 +581,19 @@ class CornerOverlay(Node):
 				spr.y = spr.startY*(1-r) + spr.endY*r
 			elif n+1 <= self.time:
 				spr.x, spr.y = spr.endX, spr.endY
+				
+	def nextChange(self):
+		if self.time < len(self.children):
+			return 0
+		return None
 		
 
 #-----------------------------------------------------------------------------
 
 class PooSignGuy(Sprite):
+	# Bounces up and down once a second when it's not being forced to a frame
+	BOUNCE = Animation([(0, 0.5), (1, 0.5)])
+	
 	def __init__(self, parent, signName, **kwargs):
 		frames = [os.path.join("poo", "poo-%d.png" % x) for x in range(4)]
 		Sprite.__init__(self, parent, frames)
@@ -260,11 +603,12 @@ class PooSignGuy(Sprite):
 		self.subtractTime = 0
 		
 	def changeSign(self, signName):
-		if self.sign != None:
-			self.sign.kill = True
-		self.sign = Sprite(self, os.path.join("sign",signName))
-		self.sign.zOrder = 10
-		self.addChild(self.sign)
+		image = os.path.join("sign",signName)
+		if self.sign == None:
+			self.sign = Sprite(self, image, zOrder=10)
+			self.addChild(self.sign)
+		else:
+			self.sign.setImage(image)
 		self._fixSign()		
 		
 	def _fixSign(self):
@@ -275,15 +619,15 @@ class PooSignGuy(Sprite):
 		
 	def update(self):
 		if self.forceFrame < 0:
-			t = self.time - self.subtractTime
-			x = math.fmod(t, 1.0)
-			if x < 0.5:
-				self.frame = 0
-			else:
-				self.frame = 1
+			self.frame = self.BOUNCE.frameAt(self.time - self.subtractTime)
 		else:
 			self.frame = self.forceFrame
 		self._fixSign()
+		
+	def nextChange(self):
+		if self.forceFrame < 0:
+			return self.BOUNCE.timeToNextFrame(self.time - self.subtractTime)
+		return None
 
 class TitleOverlay(Node):
 	def __init__(self, parent, **kwargs):
@@ -302,7 +646,7 @@ class TitleOverlay(Node):
 	def update(self):
 		# Bounce the title
 		deltat = self.game.deltat
-		#print self.title.y
+		#print(self.title.y)
 		if not self.titleStopped:
 			self.title.y += self.tv * deltat
 			self.tv += 3000.0*deltat
@@ -316,6 +660,13 @@ class TitleOverlay(Node):
 		
 		if self.time > 3.25:
 			self.poo.visible = True
+			
+	def nextChange(self):
+		if not self.titleStopped:
+			return 0
+		elif not self.poo.visible:
+			return max(3.25 - self.time, 0)
+		return None
 
 #-----------------------------------------------------------------------------	
 
@@ -337,19 +688,11 @@ class ImageRevealer(Node):
 		self.revealCount = 0
 		
 		# The images we're using (keep them alive the entire lifetime of the image revealer)
-		self.clearImage = self.game.loadImage(os.path.join("questions",self.name+".jpg"))
-		self.lessBlurryImage = self.game.loadImage(os.path.join("questions",self.name+"-lessblurry.jpg"))
-		self.blurryImage = self.game.loadImage(os.path.join("questions",self.name+"-blurry.jpg"))
+		self.clearImage, self.lessBlurryImage, self.blurryImage = \
+				[self.game.loadImage(x) for x in questionImages(self.name)]
 		
 		self._doStage(0, self.blurryImage)
 	
-	# TODO: This is probably not necessary
-	def unlink(self):
-		Node.unlink(self)
-		self.clearImage = None
-		self.lessBlurryImage = None
-		self.blurryImage = None
-		
 	def update(self):
 		if self.revealing:
 			self.revealTimer += self.game.deltat
@@ -361,23 +704,29 @@ class ImageRevealer(Node):
 		if len(self.covers) > 0:
 			cover = self.covers.pop(0)
 			cover.kill = True
-			#print "Revealed square %d" % self.revealCount
+			#print("Revealed square %d" % self.revealCount)
 			self.revealCount += 1
+			# (After an answer they go by way too fast for a sound each)
+			if self.revealInterval >= 0.25:
+				self.game.sfx.play("reveal")
 		else:
 			self._nextStage()
 			
 	def _nextStage(self):
 		if  self.stage == 0:
-			#print "Entering second stage!"
+			#print("Entering second stage!")
 			self._doStage(1, self.lessBlurryImage, self.blurryImage)
 		elif self.stage == 1:
-			#print "Entering third stage!"
+			#print("Entering third stage!")
 			self._doStage(2, self.clearImage, self.lessBlurryImage)
 		else:
 			self.revealing = False
 		
 	def _doStage(self, stageNum, baseImage, coverImage=None):
 		self.stage = stageNum
+		self.game.telemetry.emit("reveal", question=self.name, stage=stageNum)
+		if stageNum > 0:
+			self.game.sfx.play("stage")
 		self._setBaseImage(baseImage)		
 		
 		for x in self.covers:
@@ -394,12 +743,13 @@ class ImageRevealer(Node):
 			for y in range(6):
 				thisCoverImage = 'cover.png'
 				if coverImage != None:
-					surf = pygame.Surface((50,50)).convert() # TODO: Do we have to convert or not?
+					surf = self.game.surfacePool.get((50,50))
 					surf.blit(coverImageObj, (0,0), pygame.Rect((x*50, y*50, (x+1)*50, (y+1)*50)))
 					thisCoverImage = surf
-				cover = Sprite(self, thisCoverImage)
-				cover.x = (640/2)-(400/2)+x*50
-				cover.y = (480/2)-(300/2)+y*50
+				cover = self.game.spritePool.get(self, thisCoverImage)
+				cover.ownsImages = (coverImage != None)
+				cover.x = (640//2)-(400//2)+x*50
+				cover.y = (480//2)-(300//2)+y*50
 				cover.z = 5
 				self.addChild(cover)
 				self.covers.append(cover)
@@ -409,26 +759,67 @@ class ImageRevealer(Node):
 	def _setBaseImage(self, baseImage):
 		if self.baseImage != None:
 			self.baseImage.kill = True
-		self.baseImage = Sprite(self, baseImage, centered=True)
-		self.baseImage.x, self.baseImage.y = (640/2, 480/2)
+		self.baseImage = self.game.spritePool.get(self, baseImage, centered=True)
+		self.baseImage.x, self.baseImage.y = (640//2, 480//2)
 		self.baseImage.centered = True
 		self.addChild(self.baseImage)
 		
 	def revealImage(self):
-		print "Revealing image!"
+		print("Revealing image!")
 		self.revealIndex = 0
 		#self._setBaseImage(os.path.join("questions", self.name+".jpg"))
 		order = [x for x in self.covers if not x.kill]
 		random.shuffle(order)
 		t=0
 		for o in order:
-			print "%s %d -> %d" % (repr(o), o.index, t)
+			print("%s %d -> %d" % (repr(o), o.index, t))
 			o.index = t
 			t += 1
 			
 
 #-----------------------------------------------------------------------------
 
+QUESTIONS_FILE = "questions.txt"
+
+def loadQuestions(path):
+	"""Reads the question catalog: a list of (name, answer) pairs, where
+	answer is True if you can poop there. Each line of the file is a
+	name then "yes" or "no"; blank lines and # comments are skipped.
+	"""
+	questions = []
+	f = open(path)
+	for line in f:
+		line = line.split("#")[0].strip()
+		if not line:
+			continue
+		fields = line.split()
+		if len(fields) != 2 or fields[1] not in ("yes", "no"):
+			f.close()
+			raise ValueError("Bad line in %s: %r (should be a name then yes or no)" % (path, line))
+		questions.append((fields[0], fields[1] == "yes"))
+	f.close()
+	return questions
+	
+def questionImages(name):
+	"""The clear, less blurry and blurry images for a question, as paths
+	relative to images/."""
+	return [os.path.join("questions", name + suffix)
+			for suffix in (".jpg", "-lessblurry.jpg", "-blurry.jpg")]
+	
+def withImages(questions):
+	"""Drops (and complains about) questions whose images aren't there."""
+	present = []
+	for name, answer in questions:
+		missing = [x for x in questionImages(name)
+				   if not os.path.exists(os.path.join("images", x))]
+		if missing:
+			print("Leaving out question %s, missing %s" % (name, ", ".join(missing)))
+		else:
+			present.append((name, answer))
+	return present
+	
+#-----------------------------------------------------------------------------
+
 STATE_READY = 0 	# Poo sign guy says "Ready..."
 STATE_SET = 1		# Poo sign guy says "Set..."
 STATE_GO = 2		# Poo sign guy says "Go!!", you can start making a choice now
@@ -437,27 +828,14 @@ STATE_CHOSEN = 4	# Choice is final
 STATE_LIMBO = 5		# Dead, basically.
 			
 class QuestionOverlay(Node):
+	# The poo guy turning his sign around (frames 2 and 3 are side-on),
+	# timed from when _changeAndRotateSign() starts it
+	SIGN_FLIP = Animation([(2, 0.067), (3, 0.067), (2, 0.066)], loop=False)
+	
 	def __init__(self, parent, **kwargs):
 		Node.__init__(self, parent, **kwargs)
 			
-		allquestions = [("cockpit", False),
-						  ("wedding", False),
-						  ("kittens", False),
-						  ("factory", False),
-						  ("classroom", False),
-						  ("car", False),
-						  ("dojo", False),
-						  ("graduation", False),
-						  
-						  ("meiji", True),
-						  ("outhouse", True),
-						  ("japan", True),
-						  ("china", True),
-						  ("forest", True),
-						  ("lavatory", True),
-						  ("residential", True),
-						  ("ecuador", True)]
-		self.questions = allquestions
+		self.questions = self.game.questions[:]
 		random.shuffle(self.questions)
 		self.questions = self.questions[:10] # TODO: 10
 
@@ -476,8 +854,8 @@ class QuestionOverlay(Node):
 		# He flips it from "Ready", "Set", to "Go!!"
 		# Until he hits Go he isn't bouncing up and down at all.
 		self.poo = PooSignGuy(self, "ready.png")
-		self.poo.x = 640/2-400/2
-		self.poo.y = 480/2-300/2 - self.poo.imageSize[1] - 5
+		self.poo.x = 640//2-400//2
+		self.poo.y = 480//2-300//2 - self.poo.imageSize[1] - 5
 		self.poo.forceFrame = 0
 		self.addChild(self.poo)
 		self.state = STATE_READY
@@ -523,16 +901,34 @@ class QuestionOverlay(Node):
 		# Used for showing score and updating it when you win/lose
 		self.showScore = 0
 		self.scoreRollSign = 0
-	
+		
+		self.game.telemetry.startSession()
 		self._nextQuestion()
 				
 	def _nextQuestion(self):
-		if len(self.questions) == 0:
-			self.state = STATE_LIMBO
-			self.kill = True
-		else:
-			q = self.questions.pop(0)
-			self._startQuestion(q[0], q[1])
+		# Between questions is when reloaded images and questions come in
+		self.game.applyReloads()
+		self._refreshQuestions()
+		while self.questions:
+			name, answer = self.questions.pop(0)
+			try:
+				self._startQuestion(name, answer)
+				return
+			except (pygame.error, OSError) as e:
+				# Like a picture that's still being copied in
+				print("Couldn't load question %s (%s), skipping it" % (name, e))
+				self.totalQuestions -= 1
+		self.game.telemetry.emit("session-end", score=self.score)
+		self.state = STATE_LIMBO
+		self.kill = True
+			
+	def _refreshQuestions(self):
+		"""Drops any questions that have left the catalog since the game
+		started, and picks up changed answers."""
+		catalog = dict(self.game.questions)
+		self.questions = [(name, catalog[name]) for name, answer in self.questions
+						  if name in catalog]
+		self.totalQuestions = self.currQuestion + len(self.questions)
 			
 	def _updateValue(self):
 		assert self.state <= STATE_GO
@@ -545,10 +941,13 @@ class QuestionOverlay(Node):
 		self.currentValue = round(t + 200)
 			
 	def _startQuestion(self, name, answer):
+		# Load the images first; if that fails, nothing's been changed yet
+		revealer = ImageRevealer(self, name)
 		if self.revealer:
 			self.revealer.kill = True
 			
-		self.revealer = ImageRevealer(self, name)
+		self.game.telemetry.emit("question", question=name)
+		self.revealer = revealer
 		self.addChild(self.revealer)	
 		
 		self.showScore = self.score
@@ -569,6 +968,7 @@ class QuestionOverlay(Node):
 		self._updateValue()
 		
 	def _changeAndRotateSign(self, sign):
+		self.game.sfx.play("flip")
 		self.rotateSign = 1.0
 		self.signChanged = False
 		self.pendingSign = sign
@@ -594,17 +994,17 @@ class QuestionOverlay(Node):
 	def _updateRotatingSign(self):
 		self.poo.forceFrame = 0
 		if self.rotateSign > 0:
-			t = self.rotateSign
-			if t > 0.8 and t < 1:
-				self.poo.forceFrame = 2
-			if t > 0.866 and t < 0.933:
-				self.poo.forceFrame = 3	
-			if t <= 0.8 and not self.signChanged:
+			frame = self.SIGN_FLIP.frameAt(1.0 - self.rotateSign)
+			if frame != None:
+				self.poo.forceFrame = frame
+			elif not self.signChanged:
+				# Flip's done; the new sign's facing us now
 				self.poo.changeSign(self.pendingSign)
 				self.signChanged = True
 			self.rotateSign -= self.game.deltat
 		
 	def _rightAnswer(self):
+		self.game.sfx.play("right")
 		self._changeAndRotateSign('great-job.png')
 		self.answered += 1
 		self.right += 1
@@ -612,17 +1012,27 @@ class QuestionOverlay(Node):
 		self.scoreRollSign = +1
 		self.score += self.currentValue
 		self.awardedValue = self.currentValue
+		self._logAnswer(True, self.currentValue)
 		self._transitionNext()
 						
 	def _wrongAnswer(self, timeUp=False):
+		self.game.sfx.play(["wrong", "time-up"][timeUp])
 		self._changeAndRotateSign(['sorry.png', 'time-up.png'][timeUp])
 		self.answered += 1
 		self.showScore = self.score
 		self.scoreRollSign = -1
 		self.score -= self.currentValue
 		self.awardedValue = self.currentValue
+		self._logAnswer(False, -self.currentValue)
 		self._transitionNext()
 		
+	def _logAnswer(self, correct, scoreDelta):
+		# (selection is 0 if time ran out before anything was picked)
+		self.game.telemetry.emit("answer", question=self.name,
+				stage=self.revealer.stage, selection=self.selection,
+				correct=int(correct), answerTime=self.currentTime,
+				value=self.currentValue, scoreDelta=scoreDelta, score=self.score)
+		
 	def _pass(self):
 		assert 0 # Don't call
 		self._changeAndRotateSign('pass.png')
@@ -689,7 +1099,7 @@ class QuestionOverlay(Node):
 					
 			self.chooseTime -= self.game.deltat
 			if self.chooseTime <= 0:
-				print "Choice is complete"
+				print("Choice is complete")
 				# TODO: Better handling here
 				if self.selection == 0:
 					# TODO: Um, I don't think you can even get here :)
@@ -749,7 +1159,7 @@ class QuestionOverlay(Node):
 #-----------------------------------------------------------------------------
 
 class GameOverOverlay(Node):
-	def __init__(self, parent, score, **kwargs):
+	def __init__(self, parent, score, ranks=None, **kwargs):
 		Node.__init__(self, parent, **kwargs)
 		self.score = score
 		self.bg = Sprite(self, "gameover-bg.png")
@@ -769,6 +1179,18 @@ class GameOverOverlay(Node):
 		self.scoreText.y = 284-4
 		self.addChild(self.scoreText)
 		
+		# Where the score placed on the high score table
+		if ranks != None:
+			lines = ["#%d of %d today" % ranks["day"],
+					 "#%d of %d all time" % ranks["all"]]
+			for n in range(len(lines)):
+				w, h = font.size(lines[n])
+				self.addChild(Text(self, font, lines[n], x=320-w//2, y=350+n*(h+2)))
+				
+	def nextChange(self):
+		# Nothing here moves except the poo guy, who says so himself
+		return None
+		
 #-----------------------------------------------------------------------------	
 
 STATE_ALIGN = 0
@@ -777,12 +1199,44 @@ STATE_TITLE = 2
 STATE_GAME = 3
 STATE_GAMEOVER = 4
 
+# Images each state needs before it can be shown (paths relative to images/).
+# STATE_ALIGN's get loaded before the first frame; everything else is
+# streamed in the background in state order after that.
+POO_FRAMES = ["poo/poo-%d.png" % x for x in range(4)]
+STATE_ASSETS = {
+	STATE_ALIGN: ["corner-bottom-left.png",
+				  "corner-bottom-right.png",
+				  "corner-top-left.png",
+				  "corner-top-right.png"],
+	STATE_INTRO: ["intro/srh.png",
+				  "intro/1w1b.png",
+				  "intro/instructions.png",
+				  "intro/instructions2.png"],
+	STATE_TITLE: ["title.png",
+				  "sign/press-space.png"] + POO_FRAMES,
+	STATE_GAME: ["cover.png",
+				 "glove.png",
+				 "question-bg.png",
+				 "blackout.png",
+				 "sign/ready.png",
+				 "sign/set.png",
+				 "sign/go.png",
+				 "sign/choosing.png",
+				 "sign/great-job.png",
+				 "sign/sorry.png",
+				 "sign/pass.png",
+				 "sign/time-up.png"] + POO_FRAMES,
+	STATE_GAMEOVER: ["gameover-bg.png",
+					 "sign/game-over.png"] + POO_FRAMES,
+}
+
 class CoreControl(Node):
 	def __init__(self, parent, **kwargs):
 		Node.__init__(self, parent, **kwargs)
 		self.state = STATE_ALIGN
 		
 		self.lastScore = 0
+		self.lastRanks = None
 		#self.titleOverlay = None
 		#self.introOverlay = None
 		#self.gameOverlay = None
@@ -797,14 +1251,26 @@ class CoreControl(Node):
 	def update(self):
 		if self.cornerOverlay.time > 4 and self.state == STATE_ALIGN:
 			self.enterState(STATE_INTRO)
+			
+	def nextChange(self):
+		if self.state == STATE_ALIGN:
+			return max(4 - self.cornerOverlay.time, 0)
+		return None
 		
 	def changeScreen(self, screen):
 		if self.currScreen != None:
 			self.currScreen.kill = True
+			if getattr(config, "debugNodes", 0):
+				self.game.nodeTracker.requestReport()
 		self.currScreen = screen
 		self.addChild(self.currScreen)
 			
 	def onEnterState(self, state, oldstate):
+		self.game.applyReloads()
+		# Don't show a screen until its images are in (this only
+		# blocks if the background loader hasn't gotten to them yet)
+		self.game.loader.require(STATE_ASSETS[state])
+		
 		if state == STATE_ALIGN:
 			self.game.startMusic("static.ogg")
 		elif state == STATE_INTRO:
@@ -817,7 +1283,7 @@ class CoreControl(Node):
 			self.changeScreen(QuestionOverlay(self))
 			self.game.startMusic("bennyhill.ogg", True)
 		elif state == STATE_GAMEOVER:
-			self.changeScreen(GameOverOverlay(self, self.lastScore))
+			self.changeScreen(GameOverOverlay(self, self.lastScore, self.lastRanks))
 			self.game.startMusic("bennyhill.ogg", True)
 		else:
 			assert 0, "Don't know this state"
@@ -827,6 +1293,13 @@ class CoreControl(Node):
 			self.enterState(STATE_TITLE)
 		if self.state == STATE_GAME and child == self.currScreen:
 			self.lastScore = self.currScreen.score
+			self.lastRanks = None
+			if self.game.scores:
+				try:
+					self.lastRanks = self.game.scores.add(self.lastScore)
+				except sqlite3.Error as e:
+					# Still show the score, just without the ranks
+					print("Couldn't save the score (%s)" % e)
 			self.enterState(STATE_GAMEOVER)
 			
 	def onSpacePressed(self):
@@ -841,58 +1314,599 @@ class CoreControl(Node):
 
 #-----------------------------------------------------------------------------	
 
+class AssetLoader:
+	"""Decodes images on a background thread, so the game can start
+	drawing before everything is loaded.
+	
+	Paths are relative to images/, like Game.loadImage. Decoded images
+	are converted to the display format and put in the game's image
+	cache by poll() or require(), since that has to happen on the main
+	thread.
+	"""
+	def __init__(self, game):
+		self.game = game
+		self.requests = queue.Queue()
+		self.results = queue.Queue()
+		self.pending = {} # Files queued up or being decoded
+		self.thread = None
+		
+	def start(self):
+		self.thread = threading.Thread(target=self._threadMain)
+		self.thread.daemon = True
+		self.thread.start()
+		
+	def queue(self, paths):
+		"""Asks for images to be loaded in the background."""
+		for path in paths:
+			path = os.path.join(*path.split("/"))
+			f = self.game.imageFile(path)
+			if f in self.pending or f in self.game.imageCache:
+				continue
+			self.pending[f] = True
+			self.requests.put((f, False))
+			
+	def reload(self, f):
+		"""Decodes an image file again in the background. The result goes
+		to the game's reloaded images, to be swapped in when it's safe
+		(see Game.applyReloads.)"""
+		self.requests.put((f, True))
+			
+	def require(self, paths):
+		"""Makes sure the given images are in the cache, waiting on the
+		background thread for ones it's working on and loading anything
+		else right here.
+		"""
+		for path in paths:
+			path = os.path.join(*path.split("/"))
+			f = self.game.imageFile(path)
+			while f in self.pending:
+				self._store(self.results.get())
+			if f not in self.game.imageCache:
+				self.game.loadImage(path, cache=True)
+				
+	def poll(self):
+		"""Picks up whatever the background thread has finished."""
+		while 1:
+			try:
+				result = self.results.get_nowait()
+			except queue.Empty:
+				return
+			self._store(result)
+			
+	def _store(self, result):
+		f, img, shared, reload = result
+		if reload:
+			if img != None:
+				self.game.reloaded[f] = self.game.prepareImage(img, shared)
+			return
+		del self.pending[f]
+		# If it failed, or somebody already loaded it themselves, forget it
+		if img != None and f not in self.game.imageCache:
+			self.game.imageCache[f] = self.game.prepareImage(img, shared)
+			
+	def _threadMain(self):
+		while 1:
+			f, reload = self.requests.get()
+			try:
+				img, shared = self.game.decodeImage(f)
+			except:
+				# Leave it for require() to load (and complain about),
+				# or keep the old one if this was a reload
+				print("Couldn't load %s in the background" % f)
+				img, shared = None, False
+			self.results.put((f, img, shared, reload))
+			
+#-----------------------------------------------------------------------------	
+
+class AssetWatcher:
+	"""Watches files for changes by polling their modification times on
+	a background thread. Changed (or new) files come out of poll().
+	
+	Directories are watched along with everything under them.
+	"""
+	def __init__(self, paths, interval=1.0):
+		self.paths = paths
+		self.interval = interval
+		self.changes = queue.Queue()
+		self.thread = threading.Thread(target=self._threadMain)
+		self.thread.daemon = True
+		self.thread.start()
+		
+	def poll(self):
+		"""Returns the files that have changed since last time."""
+		changed = []
+		while 1:
+			try:
+				f = self.changes.get_nowait()
+			except queue.Empty:
+				return changed
+			if f not in changed:
+				changed.append(f)
+				
+	def _scan(self):
+		stamps = {}
+		for path in self.paths:
+			if os.path.isdir(path):
+				for dirpath, dirnames, filenames in os.walk(path):
+					for name in filenames:
+						self._stamp(os.path.join(dirpath, name), stamps)
+			else:
+				self._stamp(path, stamps)
+		return stamps
+		
+	def _stamp(self, f, stamps):
+		try:
+			st = os.stat(f)
+		except OSError:
+			return # Went away while we were looking
+		stamps[f] = (st.st_mtime, st.st_size)
+		
+	def _threadMain(self):
+		old = self._scan()
+		while 1:
+			time.sleep(self.interval)
+			new = self._scan()
+			for f, stamp in new.items():
+				if old.get(f) != stamp:
+					self.changes.put(f)
+			old = new
+			
+#-----------------------------------------------------------------------------	
+
+# Sound effects: name -> (file in sounds/, priority). When every channel
+# is busy, a sound can take over the channel of the oldest sound that
+# isn't more important than it.
+SOUND_EFFECTS = {
+	"flip":		("flip.wav", 1),
+	"reveal":	("reveal.wav", 0),
+	"stage":	("stage.wav", 2),
+	"right":	("right.wav", 3),
+	"wrong":	("wrong.wav", 3),
+	"time-up":	("time-up.wav", 3),
+}
+
+class SoundEffects:
+	"""Plays short sound effects on their own mixer channels (music is
+	separate, it goes through pygame.mixer.music.)
+	
+	Everything is loaded up front; pygame.mixer.Sound converts to the
+	mixer's format when it loads, so playing one never touches the disk
+	or decodes anything. Effects without a file are just skipped.
+	"""
+	def __init__(self, channels=8):
+		self.sounds = {}
+		self.channels = []
+		self.playing = [] # (priority, when it started) per channel
+		if not pygame.mixer.get_init():
+			print("No mixer, so no sound effects")
+			return
+			
+		pygame.mixer.set_num_channels(channels)
+		self.channels = [pygame.mixer.Channel(n) for n in range(channels)]
+		self.playing = [(0, 0)] * channels
+		for name, (filename, priority) in SOUND_EFFECTS.items():
+			path = os.path.join("sounds", filename)
+			if not os.path.exists(path):
+				continue
+			try:
+				self.sounds[name] = (pygame.mixer.Sound(path), priority)
+			except pygame.error:
+				print("Couldn't load sound effect %s" % path)
+		print("Loaded %d sound effects" % len(self.sounds))
+		
+	def play(self, name):
+		entry = self.sounds.get(name)
+		if entry == None:
+			return
+		sound, priority = entry
+		
+		# A free channel if there is one, otherwise steal the oldest of
+		# the least important ones (as long as it's not more important)
+		best = None
+		for n in range(len(self.channels)):
+			if not self.channels[n].get_busy():
+				best = n
+				break
+			if self.playing[n][0] <= priority and (best == None or self.playing[n] < self.playing[best]):
+				best = n
+		if best == None:
+			return
+		self.channels[best].play(sound)
+		self.playing[best] = (priority, pygame.time.get_ticks())
+		
+#-----------------------------------------------------------------------------	
+
 #MUSIC_DONE_EVENT = USEREVENT+5
+# Posted by a timer to wake us up when we're idling
+IDLE_WAKE_EVENT = USEREVENT+6
+# Never idle longer than this (seconds), so background work gets picked up
+MAX_IDLE = 0.5
+# Events that mean the window lost what was on it (like coming back
+# from alt-tab in fullscreen), so everything has to be drawn again
+REPAINT_EVENTS = (VIDEOEXPOSE, ACTIVEEVENT, WINDOWEXPOSED, WINDOWSHOWN,
+				  WINDOWRESTORED, WINDOWFOCUSGAINED)
+
+# The game is laid out for this, whatever the display really is
+SCREEN_SIZE = (640, 480)
+# If more than this much of the screen changed, just redraw all of it
+MAX_DIRTY_AREA = 0.5
+MAX_DIRTY_RECTS = 16
 
 class Game:
 	def __init__(self):
 		self.ran = False
 		self.currentMusic = None
 		self.imageCache = {}
+		self.nodeTracker = NodeTracker()
+		self.spritePool = SpritePool()
+		self.surfacePool = SurfacePool()
+		self.telemetry = None
+		self.scores = None
+		self.sharedAssets = None
+		self.spectators = None
+		self.sfx = None
+		self.watcher = None
+		# The question catalog, as (name, answer) pairs
+		self.questions = []
+		# Images decoded again after their files changed, waiting to be
+		# swapped into the cache (file -> surface)
+		self.reloaded = {}
+		# Maps image paths to (sheet path, rect) for things packed by make-atlas.py
+		self.atlas = {}
+		
+		# Frame counter, used to tell when cached per-frame stuff is stale
+		self.frame = 0
+		# Only nodes touching this rect get drawn (normally the whole screen)
+		self.renderRect = None
+		# What the game draws on (always SCREEN_SIZE), and the real
+		# display. With scaling on, the screen gets blown up by a whole
+		# number (scaleFactor) into scaledArea, a part of the display;
+		# otherwise the screen is just part of the display.
+		self.screen = None
+		self.display = None
+		self.scaledArea = None
+		self.scaleFactor = 1
+		# Culling stats, for the frame being rendered and overall
+		self.nodesDrawn = 0
+		self.nodesCulled = 0
+		self.totalDrawn = 0
+		self.totalCulled = 0
+		
+		# Input events, as (time seen, event), waiting to be handled
+		self.pendingEvents = []
+		# When the inputs handled this frame were seen
+		self.inputStamps = []
+		# Input-to-flip latencies, in seconds (only the recent ones)
+		self.inputLatencies = []
+		
+		# What got drawn last frame (see Node.getDrawKey), and whether
+		# something changed that it can't see, so we must draw anyway
+		self.lastDrawKeys = None
+		self.needsRedraw = True
+		# How long until something changes by itself (None = nothing will)
+		self.idleFor = 0
+		# Idle stats: seconds spent sleeping, total seconds, loops
+		self.idleTime = 0.0
+		self.wallTime = 0.0
+		self.updates = 0
+		# Screens' worth of pixels redrawn, over all frames
+		self.redrawnScreens = 0.0
 		
 	def run(self):
 		try:
 			self._run()
 		except QuitGameException:
 			pass
+		if self.telemetry:
+			self.telemetry.close()
+		if self.scores:
+			self.scores.close()
+		if self.spectators:
+			self.spectators.close()
+		if getattr(config, "showStats", 0):
+			self._printStats()
+		if getattr(config, "debugNodes", 0):
+			self.nodeTracker.report()
+		if self.sharedAssets:
+			# Let go of the surfaces pointing into shared memory first
+			self.core = None
+			self.imageCache = {}
+			self.sharedAssets.close()
+			
+	def _printStats(self):
+		frames = max(self.frame, 1)
+		print("*** Rendered %d frames out of %d updates" % (self.frame, self.updates))
+		print("*** Redrew %.0f%% of the screen per frame on average" % (100.0*self.redrawnScreens/frames))
+		if self.wallTime > 0:
+			print("*** Idle %.0f%% of the time" % (100.0*self.idleTime/self.wallTime))
+		print("*** Nodes drawn: %d (%.1f per frame)" % (self.totalDrawn, float(self.totalDrawn)/frames))
+		print("*** Nodes culled: %d (%.1f per frame)" % (self.totalCulled, float(self.totalCulled)/frames))
+		if self.inputLatencies:
+			latencies = sorted(self.inputLatencies)
+			def percentile(p):
+				return latencies[min(int(len(latencies)*p), len(latencies)-1)] * 1000.0
+			print("*** Input to flip latency over %d inputs: 50%% %.1f ms, 90%% %.1f ms, 99%% %.1f ms, max %.1f ms" % (
+					len(latencies), percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1]*1000.0))
 		
 	def _run(self):
 		assert not self.ran
 		self.ran = True
+		# Small mixer buffer, so effects play right when they're triggered.
+		# 44100 Hz mono: static.ogg is 44100 Hz, and the 22050 Hz music
+		# (and effects) only need every sample doubling.
+		pygame.mixer.pre_init(44100, -16, 1, getattr(config, "mixerBuffer", 512))
 		pygame.init()
-		self.screen = pygame.display.set_mode((640, 480), [0,FULLSCREEN][config.fullscreen])
+		self._setupDisplay()
 		pygame.display.set_caption("SHilbert's 1W1B Entry")
 		pygame.mouse.set_visible(0)
+		self.renderRect = self.screen.get_rect()
 				
 		self.clock = pygame.time.Clock()
-				
+		self.sfx = SoundEffects()
 		
-		self._cacheStuff()
+		telemetryPath = getattr(config, "telemetry", None)
+		if telemetryPath:
+			self.telemetry = telemetry.TelemetryWriter(telemetryPath)
+		else:
+			self.telemetry = telemetry.NullTelemetry()
+		spectatorPort = getattr(config, "spectatorPort", 0)
+		if spectatorPort:
+			if spectator.available:
+				self.spectators = spectator.SpectatorServer(spectatorPort)
+			else:
+				print("Spectating needs NumPy, not starting the spectator server")
+		scoresPath = getattr(config, "scores", None)
+		if scoresPath:
+			try:
+				self.scores = scores.ScoreBoard(scoresPath)
+			except sqlite3.Error as e:
+				print("Couldn't open score database %s (%s), not keeping scores" % (scoresPath, e))
+		
+		if getattr(config, "sharedAssets", 0):
+			if sharedassets.available:
+				self.sharedAssets = sharedassets.SharedAssets()
+			else:
+				print("Shared assets need Python 3.8+ and pygame 2, not using them")
+		self.questions = withImages(loadQuestions(QUESTIONS_FILE))
+		if getattr(config, "hotReload", 0):
+			self.watcher = AssetWatcher(["images", QUESTIONS_FILE])
+		self._loadAtlasIndex()
+		self.loader = AssetLoader(self)
+		# Just enough to show the first screen; the rest comes in later
+		self.loader.require(STATE_ASSETS[STATE_ALIGN])
+		self.loader.start()
+		for state in sorted(STATE_ASSETS.keys()):
+			self.loader.queue(STATE_ASSETS[state])
 		self.core = CoreControl(None, game=self)
 		self.clock.tick()
+		self.lastTickTicks = pygame.time.get_ticks()
 		while 1:
 			self._update()
 			
 	def _update(self):
+		if self.idleFor == None or self.idleFor > 1.0/60:
+			self._idle(self.idleFor)
+		else:
+			self._waitForFrame()
 		self.clock.tick(60)
+		self.lastTickTicks = pygame.time.get_ticks()
 		self.deltat = self.clock.get_time() / 1000.0
+		# (Time clock.tick() spent sleeping counts as idle too)
+		self.idleTime += (self.clock.get_time() - self.clock.get_rawtime()) / 1000.0
+		self.wallTime += self.deltat
+		self.updates += 1
 		if self.deltat > 0.1:
 			self.deltat = 0.1
 		
-		self._handleEvents()
+		self.loader.poll()
+		if self.spectators and self.spectators.poll():
+			# Somebody started watching; they need something to look at
+			self.needsRedraw = True
+		if self.watcher:
+			self._checkForChanges()
+		# Handle input as late as we can, right before it gets used
+		self._pollEvents()
+		handled = self._handleEvents()
 		
 		self.core.generalUpdate()
 		if self.core.kill:
 			raise QuitGameException()
+		if self.nodeTracker.reportPending:
+			self.nodeTracker.report()
+		self.idleFor = self.core.generalNextChange()
+		
+		# Skip drawing frames that would look just like the last one
+		drawKeys = []
+		self.core.collectDrawKeys(drawKeys)
+		if not handled and not self.needsRedraw and drawKeys == self.lastDrawKeys:
+			return
+		dirty = self._findDirtyRects(drawKeys)
+		self.lastDrawKeys = drawKeys
+		self.needsRedraw = False
 			
-		self.screen.fill((0,0,0))
-		self.core.generalRender()
+		self.frame += 1
+		self.nodesDrawn = 0
+		self.nodesCulled = 0
+		if dirty == None:
+			self.screen.fill((0,0,0))
+			self.core.generalRender()
+			self.redrawnScreens += 1
+		else:
+			# Only draw what changed, leaving the rest of last frame be
+			for rect in dirty:
+				self.renderRect = rect
+				self.screen.set_clip(rect)
+				self.screen.fill((0,0,0))
+				self.core.generalRender()
+				self.redrawnScreens += float(rect.w*rect.h) / (SCREEN_SIZE[0]*SCREEN_SIZE[1])
+			self.screen.set_clip(None)
+			self.renderRect = self.screen.get_rect()
+		# Whatever could have been drawn this frame but never was
+		self.core.getTreeBounds()
+		self.nodesCulled = self.core.treeCount - self.nodesDrawn
+		self.totalDrawn += self.nodesDrawn
+		self.totalCulled += self.nodesCulled
+		if self.spectators:
+			self.spectators.sendFrame(self.screen)
 			
+		self._present(dirty)
+		if self.frame == 1:
+			print("*** First frame up after %d ms" % pygame.time.get_ticks())
+		self._recordInputLatency()
+		
+	def _setupDisplay(self):
+		"""Sets up the display. With scaling on in fullscreen we take
+		whatever mode the display is already in, rather than asking for
+		a 640x480 one (which modern panels tend to fake with slow, blurry
+		scaling, if they do it at all), and scale up ourselves.
+		"""
+		if config.fullscreen and getattr(config, "scaling", 1):
+			self.display = pygame.display.set_mode((0,0), FULLSCREEN)
+			w, h = self.display.get_size()
+			self.scaleFactor = max(1, min(w // SCREEN_SIZE[0], h // SCREEN_SIZE[1]))
+		else:
+			self.display = pygame.display.set_mode(SCREEN_SIZE, [0,FULLSCREEN][config.fullscreen])
+			self.scaleFactor = 1
+			
+		# Centered, with black bars around it if it doesn't fit exactly
+		w, h = self.display.get_size()
+		scaledSize = (SCREEN_SIZE[0]*self.scaleFactor, SCREEN_SIZE[1]*self.scaleFactor)
+		area = pygame.Rect(((w-scaledSize[0])//2, (h-scaledSize[1])//2), scaledSize)
+		self.display.fill((0,0,0))
+		if self.scaleFactor == 1:
+			# Draw straight onto the display
+			self.screen = self.display.subsurface(area)
+			self.scaledArea = None
+		else:
+			# Same format as the display, so scaling is a straight copy
+			self.screen = pygame.Surface(SCREEN_SIZE, 0, self.display)
+			self.scaledArea = self.display.subsurface(area)
+			print("Scaling %dx%d up %d times for a %dx%d display" % (
+					SCREEN_SIZE[0], SCREEN_SIZE[1], self.scaleFactor, w, h))
 		pygame.display.flip()
+			
+	def _findDirtyRects(self, drawKeys):
+		"""Compares what's being drawn this frame with last frame (see
+		Node.collectDrawKeys) and returns the screen rects that need
+		drawing again, or None if it might as well be all of it.
+		"""
+		old = self.lastDrawKeys
+		if self.needsRedraw or old == None:
+			return None
+		rects = []
+		for n in range(max(len(old), len(drawKeys))):
+			before = n < len(old) and old[n] or None
+			after = n < len(drawKeys) and drawKeys[n] or None
+			if before == after:
+				continue
+			for entry in (before, after):
+				if entry != None and entry[1] != None:
+					rects.append(entry[1])
+					
+		# Clip to the screen and merge anything that overlaps
+		screenRect = self.screen.get_rect()
+		merged = []
+		for rect in rects:
+			rect = rect.clip(screenRect)
+			if rect.w == 0 or rect.h == 0:
+				continue
+			i = rect.collidelist(merged)
+			while i != -1:
+				rect = rect.union(merged.pop(i))
+				i = rect.collidelist(merged)
+			merged.append(rect)
+			
+		# (Nothing changed at all means we're here because of input;
+		# draw the lot, like we always did for input)
+		if not merged:
+			return None
+		area = sum([rect.w*rect.h for rect in merged])
+		if len(merged) > MAX_DIRTY_RECTS or area > MAX_DIRTY_AREA*screenRect.w*screenRect.h:
+			return None
+		return merged
+		
+	def _present(self, dirty):
+		"""Gets what was drawn onto the display. dirty is the list of
+		rects that changed, or None for the whole screen."""
+		whole = dirty == None
+		if whole:
+			dirty = [self.screen.get_rect()]
+		f = self.scaleFactor
+		updates = []
+		for rect in dirty:
+			if self.scaledArea != None:
+				dest = pygame.Rect(rect.x*f, rect.y*f, rect.w*f, rect.h*f)
+				# Scaling by a whole number is just repeating pixels, so
+				# the scaled-up rect comes out exactly like the whole
+				# screen would have
+				pygame.transform.scale(self.screen.subsurface(rect), dest.size,
+									   self.scaledArea.subsurface(dest))
+				offset = self.scaledArea.get_offset()
+			else:
+				dest = rect
+				offset = self.screen.get_offset()
+			updates.append(dest.move(offset))
+		if whole:
+			# The bars around the screen might need painting again too
+			pygame.display.flip()
+		else:
+			pygame.display.update(updates)
+		
+	def _waitForFrame(self):
+		"""Waits out most of the frame, picking up input as it comes in so
+		it gets timestamped when it happened rather than when the frame
+		started. clock.tick() sleeps off whatever is left.
+		"""
+		frameMs = 1000//60
+		while frameMs - (pygame.time.get_ticks() - self.lastTickTicks) > 2:
+			self._pollEvents()
+			start = preciseTime()
+			pygame.time.wait(1)
+			self.idleTime += preciseTime() - start
+		
+	def _idle(self, seconds):
+		"""Nothing's going to change for a while, so sleep until then (or
+		until some input comes in.)"""
+		if seconds == None or seconds > MAX_IDLE:
+			seconds = MAX_IDLE
+		start = preciseTime()
+		self._pollEvents()
+		if not self.pendingEvents:
+			pygame.time.set_timer(IDLE_WAKE_EVENT, max(int(seconds*1000), 1))
+			event = pygame.event.wait()
+			pygame.time.set_timer(IDLE_WAKE_EVENT, 0)
+			if event.type != IDLE_WAKE_EVENT:
+				self.pendingEvents.append((preciseTime(), event))
+		self.idleTime += preciseTime() - start
+		
+	def _pollEvents(self):
+		now = preciseTime()
+		for event in pygame.event.get():
+			self.pendingEvents.append((now, event))
+			
+	def _recordInputLatency(self):
+		if not self.inputStamps:
+			return
+		now = preciseTime()
+		for stamp in self.inputStamps:
+			self.inputLatencies.append(now - stamp)
+		self.inputStamps = []
+		if len(self.inputLatencies) > 2000:
+			del self.inputLatencies[:-1000]
 		
 	def _handleEvents(self):
-		for event in pygame.event.get():
+		"""Returns how many events got handled."""
+		events = self.pendingEvents
+		self.pendingEvents = []
+		handled = 0
+		for stamp, event in events:
+			if event.type == IDLE_WAKE_EVENT:
+				continue
+			handled += 1
 			if event.type == QUIT:
 				raise QuitGameException()
+			elif event.type in REPAINT_EVENTS:
+				self.needsRedraw = True
 			elif event.type == KEYDOWN:
 				if event.key == K_ESCAPE:
 					# TODO: For the intro, go to the title;
@@ -900,55 +1914,122 @@ class Game:
 					#		from the game, go to the title also
 					raise QuitGameException()
 				elif event.key == K_SPACE:
+					self.inputStamps.append(stamp)
 					self.core.onSpacePressed()
 			# TODO: Whatever else events we need to handle
+		return handled
+							
+	def _checkForChanges(self):
+		"""Deals with files the watcher saw change. Images that are in the
+		cache get decoded again in the background; nothing is swapped in
+		until applyReloads(), so the game on screen isn't disturbed."""
+		for f in self.watcher.poll():
+			if f == QUESTIONS_FILE:
+				try:
+					self.questions = withImages(loadQuestions(f))
+					print("Reloaded %s: %d questions" % (f, len(self.questions)))
+				except (ValueError, IOError) as e:
+					print("Couldn't reload %s (%s), keeping the old questions" % (f, e))
+				continue
+			path = f[len("images")+1:]
+			if path in self.atlas:
+				# The packed copy is out of date now, go to the file itself
+				del self.atlas[path]
+			if self.sharedAssets:
+				# Even if we don't have it cached, the next load mustn't
+				# come out of shared memory (questions aren't cached)
+				self.sharedAssets.forget(f)
+			if f in self.imageCache:
+				print("Reloading %s" % f)
+				self.loader.reload(f)
+				
+	def applyReloads(self):
+		"""Swaps reloaded images into the cache. Call this somewhere a
+		sudden change in the pictures won't matter, like between
+		questions. If the size hasn't changed the new pixels get copied
+		right over the old ones, so anything already showing the image
+		(or its atlas sheet) picks them up too.
+		
+		Not with shared assets, though: the old surface could be sitting
+		in shared memory, and writing to it would change the picture in
+		every other copy of the game too. Those just get replaced.
+		"""
+		if not self.reloaded:
+			return
+		for f, img in self.reloaded.items():
+			old = self.imageCache.get(f)
+			if old != None and old.get_size() == img.get_size() and not self.sharedAssets:
+				old.blit(img, (0,0))
+				continue
+			self.imageCache[f] = img
+			# Pieces of an atlas sheet that got replaced still point at
+			# the old one; they'll be cut out of the new one when needed
+			for path, (sheet, rect) in self.atlas.items():
+				if os.path.join("images", sheet) == f:
+					self.imageCache.pop(os.path.join("images", path), None)
+		self.reloaded = {}
+		self.needsRedraw = True
+							
+	def _loadAtlasIndex(self):
+		indexPath = os.path.join("images", "atlas.txt")
+		if not os.path.exists(indexPath):
+			return
+		f = open(indexPath)
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			sheet, x, y, w, h, name = line.split(None, 5)
+			rect = pygame.Rect(int(x), int(y), int(w), int(h))
+			self.atlas[os.path.join(*name.split("/"))] = (sheet, rect)
+		f.close()
+		print("Atlas has %d images" % len(self.atlas))
+							
+	def imageFile(self, path):
+		"""Returns the file that actually has to be decoded to get the
+		image at path (relative to images/), which is its atlas sheet if
+		it's been packed into one.
+		"""
+		atlasEntry = self.atlas.get(path)
+		if atlasEntry != None:
+			return os.path.join("images", atlasEntry[0])
+		return os.path.join("images", path)
+							
+	def decodeImage(self, f):
+		"""Decodes an image file (safe to call from any thread.)
+		Returns (surface, shared), where shared says it came out of
+		the shared asset cache. Hand both to prepareImage().
+		"""
+		if self.sharedAssets:
+			return self.sharedAssets.load(f)
+		return pygame.image.load(f), False
+		
+	def prepareImage(self, img, shared):
+		"""Gets a decoded image ready to draw (main thread only.) Shared
+		images are left as they are; converting would copy them."""
+		if shared:
+			return img
+		return img.convert()
 							
 	def loadImage(self, path, cache=False):
+		atlasEntry = self.atlas.get(path)
 		path = os.path.join("images", path)
 		img = self.imageCache.get(path)
 		if img != None:
 			return img
-		print "Loading %s" % path
-		img = pygame.image.load(path).convert()
+		if atlasEntry != None:
+			# Subsurfaces are cheap and share pixels with the sheet,
+			# so these always get cached
+			sheet, rect = atlasEntry
+			img = self.loadImage(sheet, cache=True).subsurface(rect)
+			self.imageCache[path] = img
+			return img
+		print("Loading %s" % path)
+		img = self.prepareImage(*self.decodeImage(path))
 		if cache:
 			self.imageCache[path] = img
 		return img
 		
-	def _cacheStuff(self):
-		print "*** Begin batch load"
-		images = ["corner-bottom-left.png",
-				 "corner-bottom-right.png",
-				 "corner-top-left.png",
-				 "corner-top-right.png",
-				 "cover.png",
-				 "glove.png",
-				 "question-bg.png",
-				 "title.png",
-				 "blackout.png",
-				 "poo/poo-0.png",
-				 "poo/poo-1.png",
-				 "poo/poo-2.png",
-				 "poo/poo-3.png",
-				 "sign/press-space.png",
-				 "sign/ready.png",
-				 "sign/set.png",
-				 "sign/go.png",
-				 "sign/choosing.png",
-				 "sign/great-job.png",
-				 "sign/sorry.png",
-				 "sign/pass.png",
-				 "sign/time-up.png",
-				 "sign/game-over.png",
-				 "intro/srh.png",
-				 "intro/1w1b.png",
-				 "intro/instructions.png",
-				 "intro/instructions2.png"]
-		for image in images:
-			parts = image.split("/")
-			# Don't use weakrefs for these!
-			self.loadImage(apply(os.path.join, parts), cache=True)
-		print "*** End batch load"
-		
 	# Note: playing music looks like it's Python soaking up memory,
 	# 		but it's just SDL's music player streaming the music
 	#		into memory, I believe.
@@ -968,9 +2049,9 @@ class Game:
 			pygame.mixer.music.load(path)
 			#pygame.mixer.music.set_endevent(MUSIC_DONE_EVENT)
 			pygame.mixer.music.play([0,-1][loop])
-			print "Playing %s" % path
+			print("Playing %s" % path)
 		except:
-			print "Couldn't play %s (mixer might not have loaded properly)" % path
+			print("Couldn't play %s (mixer might not have loaded properly)" % path)
 		
 		self.currentMusic = path
 			
@@ -981,6 +2062,6 @@ if __name__ == '__main__':
 	except:
 		import traceback as tb
 		tb.print_exc()
-		f = file("exception.txt", "w")
+		f = open("exception.txt", "w")
 		f.write(tb.format_exc())
 		f.close()
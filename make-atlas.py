@@ -0,0 +1,85 @@
+"""Packs the game's small sprites into a few big sheets.
+
+Writes images/atlas-N.png plus an index, images/atlas.txt, which the
+game reads at startup. Anything listed in the index gets cut out of a
+sheet instead of being loaded from its own file. Run this before
+packaging (make-dist.sh does it for you.)
+"""
+import os
+import pygame
+
+SHEET_SIZE = (256, 256)
+PADDING = 1
+INDEX = "atlas.txt"
+
+images = ["corner-bottom-left.png",
+		  "corner-bottom-right.png",
+		  "corner-top-left.png",
+		  "corner-top-right.png",
+		  "cover.png",
+		  "glove.png",
+		  "blackout.png",
+		  "poo/poo-0.png",
+		  "poo/poo-1.png",
+		  "poo/poo-2.png",
+		  "poo/poo-3.png",
+		  "sign/press-space.png",
+		  "sign/ready.png",
+		  "sign/set.png",
+		  "sign/go.png",
+		  "sign/choosing.png",
+		  "sign/great-job.png",
+		  "sign/sorry.png",
+		  "sign/pass.png",
+		  "sign/time-up.png",
+		  "sign/game-over.png"]
+
+def pack(sizes, sheetSize):
+	"""Shelf packer. Takes a list of (w,h) sizes and returns a list of
+	(sheet, x, y) placements in the same order. Tallest things go first
+	so the shelves don't waste much space.
+	"""
+	order = list(range(len(sizes)))
+	order.sort(key=lambda n: (-sizes[n][1], -sizes[n][0]))
+	placements = [None] * len(sizes)
+	sheet, x, y, shelfHeight = 0, 0, 0, 0
+	for n in order:
+		w, h = sizes[n]
+		assert w <= sheetSize[0] and h <= sheetSize[1], "Image too big for a sheet"
+		if x + w > sheetSize[0]:
+			# Start a new shelf
+			x = 0
+			y += shelfHeight + PADDING
+			shelfHeight = 0
+		if y + h > sheetSize[1]:
+			# Start a new sheet
+			sheet += 1
+			x, y, shelfHeight = 0, 0, 0
+		placements[n] = (sheet, x, y)
+		x += w + PADDING
+		shelfHeight = max(shelfHeight, h)
+	return placements
+
+def main():
+	surfs = [pygame.image.load(os.path.join("images", *name.split("/"))) for name in images]
+	placements = pack([s.get_size() for s in surfs], SHEET_SIZE)
+
+	sheets = []
+	index = open(os.path.join("images", INDEX), "w")
+	index.write("# sheet x y w h name -- generated by make-atlas.py\n")
+	for name, surf, (sheet, x, y) in zip(images, surfs, placements):
+		while len(sheets) <= sheet:
+			sheets.append(pygame.Surface(SHEET_SIZE, 0, 24))
+		sheets[sheet].blit(surf, (x,y))
+		w, h = surf.get_size()
+		index.write("atlas-%d.png %d %d %d %d %s\n" % (sheet, x, y, w, h, name))
+	index.close()
+
+	for n in range(len(sheets)):
+		path = os.path.join("images", "atlas-%d.png" % n)
+		pygame.image.save(sheets[n], path)
+		print("Wrote %s" % path)
+	print("Packed %d images into %d sheet(s)" % (len(images), len(sheets)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,55 @@
+"""Synthesizes the placeholder sound effects in sounds/.
+
+Each effect is a few plain tones with a quick fade in and out, written
+as 16-bit mono WAV. They're stand-ins until there are real recordings;
+dropping a file of the same name in sounds/ replaces one. Run it again
+after changing the table below.
+"""
+import os
+import math
+import wave
+import struct
+
+RATE = 22050
+FADE = 0.005 # Seconds, so the tones don't click at the ends
+
+# name -> list of (frequency in Hz, or 0 for silence; seconds; volume)
+EFFECTS = {
+	"flip.wav":		[(1400, 0.03, 0.4), (900, 0.03, 0.3)],
+	"reveal.wav":	[(2200, 0.015, 0.15)],
+	"stage.wav":	[(660, 0.08, 0.4), (880, 0.12, 0.4)],
+	"right.wav":	[(523, 0.08, 0.5), (659, 0.08, 0.5), (784, 0.08, 0.5), (1047, 0.2, 0.5)],
+	"wrong.wav":	[(196, 0.15, 0.5), (0, 0.04, 0), (147, 0.3, 0.5)],
+	"time-up.wav":	[(880, 0.1, 0.5), (659, 0.1, 0.5), (440, 0.25, 0.5)],
+}
+
+def tone(freq, seconds, volume):
+	n = int(RATE * seconds)
+	fade = int(RATE * FADE)
+	samples = []
+	for i in range(n):
+		envelope = min(1.0, i / float(fade), (n - i) / float(fade))
+		x = 0.0
+		if freq:
+			x = math.sin(2 * math.pi * freq * i / RATE)
+		samples.append(int(32767 * volume * envelope * x))
+	return samples
+
+def main():
+	if not os.path.isdir("sounds"):
+		os.mkdir("sounds")
+	for name in sorted(EFFECTS.keys()):
+		samples = []
+		for freq, seconds, volume in EFFECTS[name]:
+			samples += tone(freq, seconds, volume)
+		path = os.path.join("sounds", name)
+		f = wave.open(path, "wb")
+		f.setnchannels(1)
+		f.setsampwidth(2)
+		f.setframerate(RATE)
+		f.writeframes(struct.pack("<%dh" % len(samples), *samples))
+		f.close()
+		print("Wrote %s" % path)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,183 @@
+"""Persistent high score table.
+
+Every finished game goes into an SQLite table, indexed by score within
+each period (day, week, month), so top-K queries for any period are an
+index walk. For the periods that are current right now we also keep
+in memory:
+
+* a Fenwick tree of how many scores there are at each value, so rank
+  lookups and inserts take O(log range) no matter how many scores are
+  on file, and
+* a min-heap of the top K scores, so the table can be shown without
+  touching the disk.
+
+The per-value counts are kept in the database too (the counts table),
+so starting up only reads one row per distinct score, not every game
+ever played.
+"""
+import sqlite3
+import time
+import heapq
+
+# Scores are ranked exactly within +/- this; anything past it is ranked
+# as if it were right at the limit. (A game is 10 questions at 1200
+# points each at most, which comes in well under it.)
+SCORE_LIMIT = 20000
+
+PERIODS = ["all", "month", "week", "day"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+	id INTEGER PRIMARY KEY,
+	score INTEGER,
+	time REAL,
+	day TEXT,
+	week TEXT,
+	month TEXT
+);
+CREATE INDEX IF NOT EXISTS scores_all ON scores (score);
+CREATE INDEX IF NOT EXISTS scores_day ON scores (day, score);
+CREATE INDEX IF NOT EXISTS scores_week ON scores (week, score);
+CREATE INDEX IF NOT EXISTS scores_month ON scores (month, score);
+CREATE TABLE IF NOT EXISTS counts (
+	period TEXT,
+	score INTEGER,
+	n INTEGER,
+	PRIMARY KEY (period, score)
+);
+"""
+
+def periodKeys(when):
+	"""Returns {period: key} for a time, e.g. {'day': 'day:2005-06-04', ...}"""
+	t = time.localtime(when)
+	return {"all": "all",
+			"month": time.strftime("month:%Y-%m", t),
+			"week": time.strftime("week:%Y-W%W", t),
+			"day": time.strftime("day:%Y-%m-%d", t)}
+
+class ScoreCounts:
+	"""Fenwick tree counting how many scores there are at each value."""
+	def __init__(self):
+		self.tree = [0] * (2*SCORE_LIMIT + 2)
+		self.total = 0
+
+	def _index(self, score):
+		return min(max(score, -SCORE_LIMIT), SCORE_LIMIT) + SCORE_LIMIT + 1
+
+	def add(self, score, n=1):
+		self.total += n
+		i = self._index(score)
+		while i < len(self.tree):
+			self.tree[i] += n
+			i += i & -i
+
+	def countAtMost(self, score):
+		total = 0
+		i = self._index(score)
+		while i > 0:
+			total += self.tree[i]
+			i -= i & -i
+		return total
+
+	def rank(self, score):
+		"""1-based rank a score has (or would have); ties share a rank."""
+		return self.total - self.countAtMost(score) + 1
+
+class ScoreBoard:
+	def __init__(self, path, topK=10):
+		self.topK = topK
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.executescript(SCHEMA)
+		# What we have in memory, for the current key of each period
+		self.keys = {}
+		self.counts = {}
+		self.tops = {}
+		self._refresh(time.time())
+
+	def _refresh(self, when):
+		"""Loads the in-memory counts and top K for any period whose
+		current key has changed (like when the day rolls over.)"""
+		keys = periodKeys(when)
+		for period in PERIODS:
+			key = keys[period]
+			if self.keys.get(period) == key:
+				continue
+			self.keys[period] = key
+			self.counts[period] = self._loadCounts(key)
+			self.tops[period] = [x[0] for x in self._query(period, key, self.topK)]
+			heapq.heapify(self.tops[period])
+
+	def _loadCounts(self, key):
+		counts = ScoreCounts()
+		for score, n in self.db.execute("SELECT score, n FROM counts WHERE period = ?", (key,)):
+			counts.add(score, n)
+		return counts
+
+	def _query(self, period, key, k):
+		if period == "all":
+			return self.db.execute("SELECT score FROM scores ORDER BY score DESC LIMIT ?", (k,))
+		return self.db.execute("SELECT score FROM scores WHERE %s = ? ORDER BY score DESC LIMIT ?" % period,
+							   (key.split(":", 1)[1], k))
+
+	def add(self, score, when=None):
+		"""Records a score. Returns {period: (rank, total)} for the
+		periods it falls into. when defaults to now. Raises
+		sqlite3.Error if it can't be written."""
+		score = int(score)
+		if when == None:
+			when = time.time()
+		self._refresh(time.time())
+		keys = periodKeys(when)
+		try:
+			self.db.execute("INSERT INTO scores (score, time, day, week, month) VALUES (?, ?, ?, ?, ?)",
+							(score, when, keys["day"].split(":", 1)[1],
+							 keys["week"].split(":", 1)[1], keys["month"].split(":", 1)[1]))
+			for period in PERIODS:
+				self.db.execute("INSERT OR IGNORE INTO counts (period, score, n) VALUES (?, ?, 0)",
+								(keys[period], score))
+				self.db.execute("UPDATE counts SET n = n + 1 WHERE period = ? AND score = ?",
+								(keys[period], score))
+			self.db.commit()
+		except sqlite3.Error:
+			# Leave the table (and what's in memory) as it was
+			self.db.rollback()
+			raise
+
+		ranks = {}
+		for period in PERIODS:
+			if keys[period] != self.keys[period]:
+				# Backdated into a period that's over; rank it from the
+				# database and leave what's in memory for the current one
+				counts = self._loadCounts(keys[period])
+				ranks[period] = counts.rank(score), counts.total
+				continue
+			self.counts[period].add(score)
+			top = self.tops[period]
+			if len(top) < self.topK:
+				heapq.heappush(top, score)
+			elif score > top[0]:
+				heapq.heapreplace(top, score)
+			ranks[period] = self.rank(score, period)
+		return ranks
+
+	def rank(self, score, period="all"):
+		"""Returns (rank, total) for a score in the current period."""
+		counts = self.counts[period]
+		return counts.rank(score), counts.total
+
+	def top(self, period="all", key=None, k=None):
+		"""Best scores for a period, highest first. The current periods
+		come out of memory; anything else (pass key, like 'day:2005-06-04')
+		or a k bigger than the cache goes to the database."""
+		if k == None:
+			k = self.topK
+		if key == None or key == self.keys[period]:
+			if k <= self.topK:
+				return sorted(self.tops[period], reverse=True)[:k]
+			key = self.keys[period]
+		return [x[0] for x in self._query(period, key, k)]
+
+	def close(self):
+		self.db.close()
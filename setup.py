@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 import py2exe
 import glob
 
@@ -11,7 +11,7 @@ setup(name='shil-1w1b-entry',
 		url="http://www.shilbert.com",
 		windows=[{'script':'entry.py',
 				  'icon_resources': [(1, "icon.ico")]}],
-		data_files=[('.',	  ['README.txt']),
+		data_files=[('.',	  ['README.txt', 'questions.txt']),
 					('music', ['music/static.ogg',
 								'music/2001_nointro.ogg',
 								'music/bennyhill.ogg']),
@@ -25,7 +25,8 @@ setup(name='shil-1w1b-entry',
 								'images/question-bg.png',
 								'images/title.png',
 								'images/blackout.png',
-								'images/gameover-bg.png']),
+								'images/gameover-bg.png'] +
+								glob.glob("images/atlas*")),
 					('images/intro', ['images/intro/srh.png',
 									  'images/intro/1w1b.png',
 									  'images/intro/instructions.png',
@@ -44,8 +45,12 @@ setup(name='shil-1w1b-entry',
 									 'images/sign/pass.png',
 									 'images/sign/time-up.png',
 									 'images/sign/game-over.png']),
+					('sounds', glob.glob("sounds/*.wav")),
 					('misc', ['misc/arial.ttf']),
-					('src', ['config.py', 'entry.py', 'README-source.txt']),
+					('src', ['config.py', 'entry.py', 'telemetry.py', 'scores.py',
+							 'sharedassets.py', 'spectator.py',
+							 'analyze.py', 'make-atlas.py', 'make-sounds.py',
+							 'README-source.txt']),
 					# TODO: A little nicer
 					('images/questions', glob.glob("images/questions/*.jpg"))
 					]
@@ -0,0 +1,186 @@
+"""Decoded images shared between game processes on the same machine.
+
+When several copies of the game run on one host, each one would decode
+every image into its own memory. With this, the first process to start
+(the owner) puts each image it decodes into its own shared memory
+block and lists it in a manifest block. Other processes look images up
+in the manifest and wrap the shared pixels in a Surface with
+pygame.image.frombuffer, without copying them.
+
+Shared surfaces don't get convert()ed (that would copy them), so the
+pixels are published in the display's own byte order to keep blits
+from having to swizzle them. Anything not in the manifest yet just
+gets decoded locally as usual.
+
+Needs multiprocessing.shared_memory (Python 3.8+) and a pygame with
+frombuffer; available is False otherwise.
+"""
+import hashlib
+import struct
+import threading
+import pygame
+try:
+	from multiprocessing import shared_memory
+	from multiprocessing import resource_tracker
+except ImportError:
+	shared_memory = None
+
+available = shared_memory != None and hasattr(pygame.image, "frombuffer")
+
+MAGIC = b"YCPH"
+MANIFEST_SIZE = 64*1024
+# Manifest: magic, bytes of entries used; then lines of
+# "path\tblock\tw\th\tlayout\n"
+MANIFEST_HEADER = struct.Struct("<4sI")
+# Image blocks: magic, width, height; then the pixels, 4 bytes each in
+# the entry's layout
+IMAGE_HEADER = struct.Struct("<4sII")
+# The 32-bit layouts frombuffer can wrap. BGRA is the common display
+# format with an (unused, always opaque) alpha byte where the X goes.
+LAYOUTS = ["RGBX", "BGRA"]
+
+class SharedAssets:
+	def __init__(self, prefix="ycph"):
+		assert available, "Shared memory assets need Python 3.8+ and pygame 2"
+		self.prefix = prefix
+		self.lock = threading.Lock()
+		self.blocks = {} # name -> SharedMemory, kept open while surfaces use them
+		self.entries = {} # path -> (block name, w, h)
+		self.versions = {} # path -> how many times it's been forgotten
+		self.manifestUsed = 0
+		self.layout = None
+		try:
+			self.manifest = shared_memory.SharedMemory(name=prefix + "-manifest",
+					create=True, size=MANIFEST_SIZE)
+			self.owner = True
+			MANIFEST_HEADER.pack_into(self.manifest.buf, 0, MAGIC, 0)
+		except OSError:
+			self.manifest = self._attach(prefix + "-manifest")
+			self.owner = False
+		print("Shared assets: %s" % ["attached to another process's", "owner of the"][self.owner] +
+			  " manifest")
+
+	def _attach(self, name):
+		try:
+			return shared_memory.SharedMemory(name=name, track=False)
+		except TypeError:
+			# Before 3.13 the resource tracker would unlink the block
+			# when we exit, pulling it out from under everybody else
+			shm = shared_memory.SharedMemory(name=name)
+			resource_tracker.unregister(shm._name, "shared_memory")
+			return shm
+
+	def _readManifest(self):
+		magic, used = MANIFEST_HEADER.unpack_from(self.manifest.buf, 0)
+		if magic != MAGIC or used == self.manifestUsed:
+			return
+		start = MANIFEST_HEADER.size
+		text = bytes(self.manifest.buf[start+self.manifestUsed:start+used]).decode("utf-8")
+		for line in text.splitlines():
+			path, name, w, h, layout = line.split("\t")
+			self.entries[path] = (name, int(w), int(h), layout)
+		self.manifestUsed = used
+
+	def load(self, path):
+		"""Returns (surface, shared) for an image file; shared says
+		whether the surface lives in shared memory."""
+		self.lock.acquire()
+		try:
+			self._readManifest()
+			entry = self.entries.get(path)
+			if entry != None:
+				return self._wrap(*entry), True
+		finally:
+			self.lock.release()
+
+		img = pygame.image.load(path)
+		if not self.owner:
+			return img, False
+		self.lock.acquire()
+		try:
+			if path in self.entries:
+				# Somebody else decoded it while we were at it
+				return self._wrap(*self.entries[path]), True
+			return self._publish(path, img), True
+		finally:
+			self.lock.release()
+
+	def forget(self, path):
+		"""Call when an image file has changed, so the next load() decodes
+		it again. The owner publishes the new pixels in a new block (the
+		old one stays around for whoever still uses it), and the new
+		manifest entry takes over from the old one in every process."""
+		self.lock.acquire()
+		try:
+			self._readManifest()
+			self.entries.pop(path, None)
+			self.versions[path] = self.versions.get(path, 0) + 1
+		finally:
+			self.lock.release()
+			
+	def _wrap(self, name, w, h, layout):
+		shm = self.blocks.get(name)
+		if shm == None:
+			shm = self._attach(name)
+			self.blocks[name] = shm
+		start = IMAGE_HEADER.size
+		surf = pygame.image.frombuffer(shm.buf[start:start+w*h*4], (w,h), layout)
+		if layout == "BGRA":
+			# Every pixel's opaque; don't blend with the alpha byte
+			surf.set_alpha(None)
+		return surf
+
+	def _nativeLayout(self):
+		"""Picks the layout whose colour masks match the display's, so
+		blitting a shared surface doesn't need to move bytes around."""
+		if self.layout == None:
+			display = pygame.display.get_surface()
+			if display == None:
+				return LAYOUTS[0] # Too early to tell; check again next time
+			self.layout = LAYOUTS[0]
+			for layout in LAYOUTS:
+				probe = pygame.image.frombuffer(bytearray(4), (1,1), layout)
+				if probe.get_masks()[:3] == display.get_masks()[:3]:
+					self.layout = layout
+					break
+		return self.layout
+
+	def _publish(self, path, img):
+		w, h = img.get_size()
+		layout = self._nativeLayout()
+		pixels = pygame.image.tostring(img, layout)
+		key = "%s\t%d" % (path, self.versions.get(path, 0))
+		name = "%s-%s" % (self.prefix, hashlib.md5(key.encode("utf-8")).hexdigest()[:16])
+		size = IMAGE_HEADER.size + len(pixels)
+		try:
+			shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+		except OSError:
+			# Left behind by an owner that crashed
+			stale = self._attach(name)
+			stale.close()
+			stale.unlink()
+			shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+		IMAGE_HEADER.pack_into(shm.buf, 0, MAGIC, w, h)
+		shm.buf[IMAGE_HEADER.size:IMAGE_HEADER.size+len(pixels)] = pixels
+		self.blocks[name] = shm
+
+		# Append to the manifest, then bump the used count so readers see it
+		line = ("%s\t%s\t%d\t%d\t%s\n" % (path, name, w, h, layout)).encode("utf-8")
+		start = MANIFEST_HEADER.size + self.manifestUsed
+		if start + len(line) <= MANIFEST_SIZE:
+			self.manifest.buf[start:start+len(line)] = line
+			self.manifestUsed += len(line)
+			MANIFEST_HEADER.pack_into(self.manifest.buf, 0, MAGIC, self.manifestUsed)
+		self.entries[path] = (name, w, h, layout)
+		return self._wrap(name, w, h, layout)
+
+	def close(self):
+		"""Lets go of the shared memory. The owner unlinks the names too;
+		processes still attached keep their mappings."""
+		for shm in list(self.blocks.values()) + [self.manifest]:
+			try:
+				shm.close()
+			except BufferError:
+				pass # Surfaces still point into it; it goes when we exit
+			if self.owner:
+				shm.unlink()
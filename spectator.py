@@ -0,0 +1,229 @@
+"""Streams the game to spectator screens over the local network.
+
+SpectatorServer compares each rendered frame to the last one on a grid
+of 16x16 tiles (using NumPy, so it's one vectorized compare instead of
+a loop over pixels), zlib-compresses just the tiles that changed, and
+queues the result up for every connected viewer. Sockets are
+non-blocking and each viewer has its own backlog; one that falls too
+far behind has its backlog dropped and gets a full frame instead, so a
+slow viewer never holds up the game. When nobody is watching, no work
+gets done at all.
+
+Run this file to watch:  python spectator.py HOST [PORT]
+
+Protocol: every message is a header (FRAME) followed by a zlib-packed
+payload: the (x, y) tile number of each tile as two little-endian
+uint16s, then each tile's pixels as RGB, column by column (the way
+pygame.surfarray lays them out.)
+"""
+import sys
+import socket
+import struct
+import zlib
+import errno
+import pygame
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+available = numpy != None
+
+DEFAULT_PORT = 4455
+TILE = 16
+# magic, frame number, width, height, tile size, tile count, payload bytes
+FRAME = struct.Struct("<4sIHHHII")
+MAGIC = b"YCPF"
+# If a viewer gets this far behind, skip to a fresh full frame
+MAX_BACKLOG = 4*1024*1024
+
+class Viewer:
+	def __init__(self, sock, address):
+		self.sock = sock
+		self.address = address
+		self.backlog = []
+		self.backlogBytes = 0
+		self.needsKeyframe = True
+
+class SpectatorServer:
+	def __init__(self, port=DEFAULT_PORT):
+		assert available, "Spectating needs NumPy"
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(("", port))
+		self.listener.listen(5)
+		self.listener.setblocking(0)
+		self.viewers = []
+		self.frame = 0
+		self.size = None
+		self.prev = None
+		self.curr = None
+		print("Spectators can connect on port %d" % port)
+
+	def _setup(self, size):
+		# Pad up to whole tiles so the grid compare is a plain reshape
+		w, h = size
+		padded = ((w+TILE-1)//TILE*TILE, (h+TILE-1)//TILE*TILE)
+		self.size = size
+		self.prev = numpy.zeros(padded, numpy.uint32)
+		self.curr = numpy.zeros(padded, numpy.uint32)
+		for viewer in self.viewers:
+			viewer.needsKeyframe = True
+
+	def poll(self):
+		"""Takes on new viewers and sends whatever is waiting to go out.
+		Cheap; call it every time around the main loop, frame drawn or
+		not, so the game sitting idle doesn't leave viewers hanging.
+		Returns whether anybody new showed up (they need a frame.)"""
+		joined = self._accept()
+		for viewer in self.viewers[:]:
+			self._flush(viewer)
+		return joined
+
+	def sendFrame(self, surface):
+		"""Call once per rendered frame, with whatever got drawn. Queues
+		the changes up for every viewer and starts sending them."""
+		self._accept()
+		if not self.viewers:
+			return
+		if surface.get_size() != self.size:
+			self._setup(surface.get_size())
+		self.frame += 1
+
+		w, h = self.size
+		pixels = pygame.surfarray.pixels2d(surface)
+		self.curr[:w,:h] = pixels
+		del pixels # Unlocks the surface
+
+		tilesX, tilesY = self.curr.shape[0]//TILE, self.curr.shape[1]//TILE
+		changed = (self.curr != self.prev).reshape(tilesX, TILE, tilesY, TILE).any(axis=3).any(axis=1)
+		self.prev, self.curr = self.curr, self.prev
+
+		delta = None
+		keyframe = None
+		rgb = pygame.surfarray.pixels3d(surface)
+		try:
+			for viewer in self.viewers:
+				if viewer.needsKeyframe:
+					if keyframe == None:
+						keyframe = self._encode(rgb, numpy.ones(changed.shape, bool))
+					self._queue(viewer, keyframe)
+					viewer.needsKeyframe = False
+				elif changed.any():
+					if delta == None:
+						delta = self._encode(rgb, changed)
+					self._queue(viewer, delta)
+		finally:
+			del rgb
+
+		for viewer in self.viewers[:]:
+			self._flush(viewer)
+
+	def _encode(self, rgb, tiles):
+		w, h = self.size
+		xs, ys = numpy.nonzero(tiles)
+		parts = [numpy.array([xs, ys], numpy.uint16).T.astype("<u2").tobytes()]
+		for tx, ty in zip(xs, ys):
+			x, y = tx*TILE, ty*TILE
+			parts.append(numpy.ascontiguousarray(rgb[x:min(x+TILE,w), y:min(y+TILE,h)]).tobytes())
+		payload = zlib.compress(b"".join(parts), 1)
+		return FRAME.pack(MAGIC, self.frame, w, h, TILE, len(xs), len(payload)) + payload
+
+	def _queue(self, viewer, message):
+		if viewer.backlogBytes + len(message) > MAX_BACKLOG:
+			# Way behind; drop it all and start them over with a full frame
+			viewer.backlog = []
+			viewer.backlogBytes = 0
+			viewer.needsKeyframe = True
+			return
+		viewer.backlog.append(message)
+		viewer.backlogBytes += len(message)
+
+	def _flush(self, viewer):
+		while viewer.backlog:
+			try:
+				sent = viewer.sock.send(viewer.backlog[0])
+			except socket.error as e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				self._drop(viewer)
+				return
+			viewer.backlogBytes -= sent
+			if sent < len(viewer.backlog[0]):
+				viewer.backlog[0] = viewer.backlog[0][sent:]
+				return
+			viewer.backlog.pop(0)
+
+	def _accept(self):
+		joined = False
+		while 1:
+			try:
+				sock, address = self.listener.accept()
+			except socket.error:
+				return joined
+			joined = True
+			sock.setblocking(0)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.viewers.append(Viewer(sock, address))
+			print("Spectator connected from %s:%d" % address)
+
+	def _drop(self, viewer):
+		print("Spectator at %s:%d went away" % viewer.address)
+		viewer.sock.close()
+		self.viewers.remove(viewer)
+
+	def close(self):
+		for viewer in self.viewers:
+			viewer.sock.close()
+		self.viewers = []
+		self.listener.close()
+
+#-----------------------------------------------------------------------------
+
+def _readExactly(sock, n):
+	chunks = []
+	while n > 0:
+		chunk = sock.recv(n)
+		if not chunk:
+			raise EOFError()
+		chunks.append(chunk)
+		n -= len(chunk)
+	return b"".join(chunks)
+
+def watch(host, port=DEFAULT_PORT):
+	"""A bare-bones viewer: rebuilds frames from the tiles and shows them."""
+	sock = socket.create_connection((host, port))
+	pygame.init()
+	screen = None
+	try:
+		while 1:
+			for event in pygame.event.get():
+				if event.type == pygame.QUIT:
+					return
+			magic, frame, w, h, tile, count, length = FRAME.unpack(_readExactly(sock, FRAME.size))
+			assert magic == MAGIC, "Not a spectator stream"
+			data = zlib.decompress(_readExactly(sock, length))
+			if screen == None or screen.get_size() != (w, h):
+				screen = pygame.display.set_mode((w, h))
+				pygame.display.set_caption("Spectating %s" % host)
+			coords = numpy.frombuffer(data[:count*4], "<u2").reshape(count, 2)
+			offset = count*4
+			rgb = pygame.surfarray.pixels3d(screen)
+			for tx, ty in coords:
+				x, y = int(tx)*tile, int(ty)*tile
+				tw, th = min(tile, w-x), min(tile, h-y)
+				size = tw*th*3
+				rgb[x:x+tw, y:y+th] = numpy.frombuffer(data[offset:offset+size], numpy.uint8).reshape(tw, th, 3)
+				offset += size
+			del rgb
+			pygame.display.flip()
+	except EOFError:
+		print("Game went away")
+	finally:
+		sock.close()
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print("Usage: python spectator.py HOST [PORT]")
+		sys.exit(1)
+	watch(sys.argv[1], len(sys.argv) > 2 and int(sys.argv[2]) or DEFAULT_PORT)
@@ -0,0 +1,118 @@
+"""Session telemetry for the game.
+
+Game code calls emit() with structured events (question shown, reveal
+stage, answer, ...), which just drops them on a queue. A background
+thread drains the queue and writes the events to SQLite in batches, so
+logging never holds up a frame. The database is in WAL mode so the
+analysis tools can read it while a kiosk is still writing.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import queue
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+	id TEXT PRIMARY KEY,
+	host TEXT,
+	started REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+	id INTEGER PRIMARY KEY,
+	session TEXT,
+	time REAL,
+	kind TEXT,
+	question TEXT,
+	stage INTEGER,
+	selection INTEGER,
+	correct INTEGER,
+	answerTime REAL,
+	value INTEGER,
+	scoreDelta INTEGER,
+	score INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (session);
+"""
+
+# Everything an event can have besides its session, time and kind
+FIELDS = ["question", "stage", "selection", "correct",
+		  "answerTime", "value", "scoreDelta", "score"]
+
+INSERT_EVENT = "INSERT INTO events (session, time, kind, %s) VALUES (?, ?, ?, %s)" % (
+		", ".join(FIELDS), ", ".join(["?"] * len(FIELDS)))
+
+class TelemetryWriter:
+	def __init__(self, path, batchSize=200, flushInterval=1.0):
+		self.path = path
+		self.batchSize = batchSize
+		self.flushInterval = flushInterval
+		self.queue = queue.Queue()
+		self.session = None
+		self.thread = threading.Thread(target=self._threadMain)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def startSession(self):
+		"""Starts a new session (one game); later events belong to it."""
+		now = time.time()
+		host = socket.gethostname()
+		self.session = "%s-%d-%d" % (host, int(now*1000), os.getpid())
+		self.queue.put(("session", (self.session, host, now)))
+		return self.session
+
+	def emit(self, kind, **fields):
+		"""Records an event for the current session. Cheap; the actual
+		writing happens on the background thread."""
+		for key in fields:
+			assert key in FIELDS, "Unknown telemetry field %s" % key
+		row = [self.session, time.time(), kind] + [fields.get(key) for key in FIELDS]
+		self.queue.put(("event", row))
+
+	def close(self, timeout=5.0):
+		"""Writes out whatever is still queued and stops the thread."""
+		self.queue.put(None)
+		self.thread.join(timeout)
+
+	def _threadMain(self):
+		try:
+			db = sqlite3.connect(self.path)
+			db.execute("PRAGMA journal_mode=WAL")
+			db.execute("PRAGMA synchronous=NORMAL")
+			db.executescript(SCHEMA)
+		except sqlite3.Error as e:
+			print("Couldn't open telemetry database %s (%s), not logging" % (self.path, e))
+			db = None
+
+		done = False
+		while not done:
+			# Wait for something, then grab whatever else has piled up
+			batch = []
+			try:
+				batch.append(self.queue.get(True, self.flushInterval))
+				while len(batch) < self.batchSize:
+					batch.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			if None in batch:
+				done = True
+				batch = [x for x in batch if x != None]
+			if db == None or not batch:
+				continue
+
+			try:
+				db.executemany("INSERT OR IGNORE INTO sessions (id, host, started) VALUES (?, ?, ?)",
+							   [x[1] for x in batch if x[0] == "session"])
+				db.executemany(INSERT_EVENT, [x[1] for x in batch if x[0] == "event"])
+				db.commit()
+			except sqlite3.Error as e:
+				print("Couldn't write %d telemetry events (%s)" % (len(batch), e))
+		if db != None:
+			db.close()
+
+class NullTelemetry:
+	"""Stands in for TelemetryWriter when telemetry is turned off."""
+	def startSession(self): return None
+	def emit(self, kind, **fields): pass
+	def close(self): pass